@@ -0,0 +1,197 @@
+"""Local stand-in for the spotidownloader API, the audio host and the cover CDN.
+
+Serves metadata/, tracks/ and download/ like the API does, synthetic MP3 files (with Range support)
+under /audio/ and placeholder cover art under /cover/, with configurable latency, bandwidth and
+error rates. Playlists are named bench0, bench1, ... and each has --tracks tracks.
+
+    python benchmarks/mock_server.py --port 8800 --latency 0.05 --bandwidth 2000000
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+BITRATE_INDEX = {32: 1, 64: 5, 96: 7, 128: 9, 160: 10, 192: 11, 256: 13, 320: 14}
+SEND_CHUNK = 16 * 1024
+
+def synthetic_mp3(bitrate, duration):
+    # MPEG-1 Layer III frames at 44.1kHz, silent but valid enough for the bitrate probe
+    header = bytes([0xFF, 0xFB, BITRATE_INDEX[bitrate] << 4, 0x44])
+    frame = header + b"\x00" * (144 * bitrate * 1000 // 44100 - 4)
+    return frame * int(duration * 44100 / 1152)
+
+def placeholder_cover(size=20 * 1024):
+    return b"\xff\xd8\xff\xe0" + b"\x00" * (size - 6) + b"\xff\xd9"
+
+class MockState:
+    def __init__(self, options):
+        self.options = options
+        self.payloads = {bitrate: synthetic_mp3(bitrate, options.duration) for bitrate in set(options.bitrates)}
+        self.cover = placeholder_cover()
+        self.random = random.Random(options.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def draw(self):
+        # Returns the delay to add to a request and a roll of the dice for the error rates
+        latency = self.options.latency
+        with self.lock:
+            self.requests += 1
+            delay = max(0.0, self.random.gauss(latency, latency / 4)) if latency else 0.0
+            return delay, self.random.random()
+
+    def bitrate_of(self, track_id):
+        # Stable per track, so reruns download the same thing
+        return self.options.bitrates[zlib.crc32(track_id.encode()) % len(self.options.bitrates)]
+
+    def track(self, playlist_id, position):
+        track_id = f"{playlist_id}t{position:05d}"
+        return {
+            "id": track_id,
+            "title": f"Track {position}",
+            "artists": f"Artist {playlist_id}",
+            "album": f"Album {playlist_id} {position // 10}",
+            "cover": f"{self.options.base_url}/cover/{playlist_id}-{position // 10}.jpg",
+            "trackNumber": position % 10 + 1,
+        }
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # Clients close idle keep-alive connections whenever they like, that is not an error
+        try:
+            super().handle()
+        except (ConnectionResetError, BrokenPipeError):
+            self.close_connection = True
+
+    def do_GET(self):
+        options = self.state.options
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        delay, roll = self.state.draw()
+        time.sleep(delay)
+        if roll < options.throttle_rate:
+            return self.send_bytes(b"", status=429, headers={"Retry-After": "1"})
+        if roll < options.throttle_rate + options.error_rate:
+            return self.send_bytes(b"", status=503)
+
+        route = [
+            (r"/metadata/(\w+)/(\w+)", self.metadata),
+            (r"/tracks/(\w+)/(\w+)", self.tracks),
+            (r"/download/(\w+)", self.download),
+            (r"/audio/(\w+)", self.audio),
+            (r"/cover/([\w-]+)\.jpg", self.cover),
+        ]
+        for pattern, handler in route:
+            match = re.fullmatch(pattern, url.path)
+            if match:
+                return handler(query, *match.groups())
+        self.send_bytes(b"", status=404)
+
+    def metadata(self, query, mode, playlist_id):
+        self.send_json({"success": True, "title": f"Bench {playlist_id}", "artists": "spdl"})
+
+    def tracks(self, query, mode, playlist_id):
+        options = self.state.options
+        offset = int(query.get("offset", ["0"])[0])
+        end = min(offset + options.page_size, options.tracks)
+        self.send_json({
+            "trackList": [self.state.track(playlist_id, position) for position in range(offset, end)],
+            "nextOffset": end if end < options.tracks else None,
+        })
+
+    def download(self, query, track_id):
+        playlist_id, position = track_id.rsplit("t", 1)
+        track = self.state.track(playlist_id, int(position))
+        self.send_json({
+            "statusCode": 200,
+            "success": True,
+            "link": f"{self.state.options.base_url}/audio/{track_id}",
+            "metadata": {
+                "title": track["title"],
+                "artists": track["artists"],
+                "album": track["album"],
+                "releaseDate": "2024-01-01",
+                "cover": track["cover"],
+            },
+        })
+
+    def audio(self, query, track_id):
+        bitrate = self.state.bitrate_of(track_id)
+        data = self.state.payloads[bitrate]
+        etag = f'"{bitrate}-{len(data)}"'
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range") in (None, etag):
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            if start >= len(data):
+                return self.send_bytes(b"", status=416, headers={"Content-Range": f"bytes */{len(data)}"})
+            end = min(end, len(data) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            return self.send_bytes(data[start:end + 1], status=206, headers=headers, throttle=True)
+        self.send_bytes(data, headers=headers, throttle=True)
+
+    def cover(self, query, name):
+        self.send_bytes(self.state.cover, content_type="image/jpeg")
+
+    def send_json(self, payload):
+        self.send_bytes(json.dumps(payload).encode(), content_type="application/json")
+
+    def send_bytes(self, body, status=200, content_type="application/octet-stream", headers=None, throttle=False):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        bandwidth = self.state.options.bandwidth if throttle else 0
+        try:
+            for start in range(0, len(body), SEND_CHUNK):
+                chunk = body[start:start + SEND_CHUNK]
+                self.wfile.write(chunk)
+                if bandwidth:
+                    time.sleep(len(chunk) / bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Mock spotidownloader API and CDN for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean delay added to every request, in seconds")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Bytes per second per audio transfer (0: unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429 and Retry-After")
+    parser.add_argument("--tracks", type=int, default=50, help="Tracks per playlist")
+    parser.add_argument("--page-size", type=int, default=100, help="Tracks per listing page")
+    parser.add_argument("--bitrates", type=lambda value: [int(b) for b in value.split(",")], default=[320], help="Comma separated bitrates the tracks are spread over, e.g. 320,320,128")
+    parser.add_argument("--duration", type=float, default=30, help="Length of every track, in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+def make_server(options):
+    options.base_url = f"http://{options.host}:{options.port}"
+    handler = type("BoundMockHandler", (MockHandler,), {"state": MockState(options)})
+    server = ThreadingHTTPServer((options.host, options.port), handler)
+    server.daemon_threads = True
+    return server
+
+if __name__ == "__main__":
+    options = make_parser().parse_args()
+    server = make_server(options)
+    print(f"Mock server listening on {options.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
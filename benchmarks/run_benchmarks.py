@@ -0,0 +1,245 @@
+"""End to end throughput benchmarks of spdl against the local mock server (mock_server.py).
+
+Every scenario gets a fresh mock server and runs spdl in a child process of its own, through
+check_track_playlist (-link) or sync_playlist_folders (-sync), and reports tracks/sec, per-track
+latency, peak RSS of the child and bytes on disk. "tracks" counts the tracks spdl worked on and "files"
+the MP3 files in the download folders afterwards. Save the results of one commit with --output and
+compare another commit against them with --baseline.
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --baseline before.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+TOKEN_ENV = "SPDL_BENCH_TOKEN"
+
+SCENARIOS = [
+    {"name": "playlist-1-worker", "kind": "link", "playlists": 1, "workers": 1,
+     "server": {"tracks": 40, "latency": 0.05, "bandwidth": 4e6}},
+    {"name": "playlist-8-workers", "kind": "link", "playlists": 1, "workers": 8,
+     "server": {"tracks": 40, "latency": 0.05, "bandwidth": 4e6}},
+    {"name": "playlist-defer-low-quality", "kind": "link", "playlists": 1, "workers": 4, "quality": "defer",
+     "server": {"tracks": 40, "latency": 0.05, "bandwidth": 4e6, "bitrates": [320, 320, 128]}},
+    {"name": "sync-4-playlists-8-workers", "kind": "sync", "playlists": 4, "workers": 8,
+     "server": {"tracks": 25, "latency": 0.05, "bandwidth": 4e6, "page_size": 10}},
+    {"name": "sync-flaky-api", "kind": "sync", "playlists": 2, "workers": 4,
+     "server": {"tracks": 25, "latency": 0.05, "bandwidth": 4e6, "error_rate": 0.05, "throttle_rate": 0.02}},
+    {"name": "sync-up-to-date", "kind": "sync", "playlists": 4, "workers": 8, "warm": True,
+     "server": {"tracks": 25, "latency": 0.05, "page_size": 10}},
+]
+
+# Metrics where a higher value is better, for the comparison with a baseline
+HIGHER_IS_BETTER = {"tracks_per_sec"}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_mock_server(port, server_options):
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_server.py"), "--port", str(port)]
+    for name, value in server_options.items():
+        if isinstance(value, list):
+            value = ",".join(str(item) for item in value)
+        command += [f"--{name.replace('_', '-')}", str(value)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    server.stdout.readline() # Listening
+    return server
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def round_or_none(value, digits=3):
+    return None if value is None else round(value, digits)
+
+def disk_usage(path):
+    # Allocated bytes, counting hard linked files once
+    seen = set()
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            stat = os.lstat(os.path.join(root, name))
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_blocks * 512
+    return total
+
+def count_tracks(path):
+    return sum(
+        1 for _, _, files in os.walk(path)
+        for name in files if name.endswith(".mp3") and not name.startswith("temp_")
+    )
+
+def run_spdl(scenario, base_url, outdir):
+    import downloader
+    import sync
+    import http_client
+    import cover_cache
+    import snapshots
+    import token_manager
+
+    workers = scenario["workers"]
+    quality = scenario.get("quality", "all")
+    http_client.configure(workers=workers)
+    token_manager.configure(f"env:{TOKEN_ENV}")
+    cover_cache.configure(cache_dir=os.path.join(outdir, ".spdl-cache"))
+    snapshots.configure(cache_dir=os.path.join(outdir, ".spdl-cache"))
+    links = [f"https://open.spotify.com/playlist/bench{i}" for i in range(scenario["playlists"])]
+    if scenario["kind"] == "link":
+        for link in links:
+            downloader.check_track_playlist(link, outdir, True, 1, token_manager.tokens.get(), workers=workers, quality=quality)
+    else:
+        sync_file = os.path.join(outdir, "sync.json")
+        entries = [{"convention_code": 1, "trackname_convention": "Title - Artist"}]
+        entries += [{"name": link, "link": link, "download_location": outdir, "create_folder": True} for link in links]
+        with open(sync_file, "w") as f:
+            json.dump(entries, f)
+        sync.sync_playlist_folders(sync_file, workers=workers, quality=quality)
+
+def run_child(spec):
+    # Runs in the child process, so RSS and imports are measured for spdl alone
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(spec["workdir"])
+    from logging_config import setup_logging
+    import downloader
+
+    setup_logging() # spdl.log in the scenario's directory
+
+    scenario = spec["scenario"]
+    outdir = os.path.join(spec["workdir"], "out")
+    os.makedirs(outdir, exist_ok=True)
+    durations = []
+    download_playlist_track = downloader.download_playlist_track
+
+    def timed_track(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return download_playlist_track(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - started)
+    downloader.download_playlist_track = timed_track
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        if scenario.get("warm"):
+            run_spdl(scenario, spec["base_url"], outdir)
+            durations.clear()
+        started = time.perf_counter()
+        run_spdl(scenario, spec["base_url"], outdir)
+        elapsed = time.perf_counter() - started
+    with open(spec["result"], "w") as f:
+        json.dump({"elapsed": elapsed, "durations": durations}, f)
+
+def run_scenario(scenario, keep=False):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = start_mock_server(port, scenario["server"])
+    workdir = tempfile.mkdtemp(prefix=f"spdl-bench-{scenario['name']}-")
+    try:
+        spec = {"scenario": scenario, "base_url": base_url, "workdir": workdir, "result": os.path.join(workdir, "result.json")}
+        env = dict(os.environ, SPDL_API_BASE_URL=base_url)
+        env[TOKEN_ENV] = "benchmark"
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", json.dumps(spec)], env=env)
+        _, status, usage = os.wait4(child.pid, 0)
+        child.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status
+        if child.returncode != 0:
+            raise RuntimeError(f"Scenario {scenario['name']} failed with exit code {child.returncode}")
+        with open(spec["result"]) as f:
+            result = json.load(f)
+        outdir = os.path.join(workdir, "out")
+        disk = disk_usage(outdir)
+        files = count_tracks(outdir)
+    finally:
+        server.terminate()
+        server.wait()
+        if keep:
+            print(f"Kept the files of {scenario['name']} in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    tracks = len(result["durations"])
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return {
+        "tracks": tracks,
+        "seconds": round(result["elapsed"], 3),
+        "tracks_per_sec": round(tracks / result["elapsed"], 2) if result["elapsed"] else None,
+        "p50_track_sec": round_or_none(percentile(result["durations"], 0.50)),
+        "p99_track_sec": round_or_none(percentile(result["durations"], 0.99)),
+        "peak_rss_mb": round(peak_rss / 2**20, 1),
+        "files": files,
+        "disk_mb": round(disk / 2**20, 1),
+    }
+
+def format_value(value):
+    if value is None:
+        return "-"
+    return f"{value:.3f}" if isinstance(value, float) and value < 10 else str(value)
+
+def print_results(results, baseline=None):
+    columns = ["tracks", "files", "seconds", "tracks_per_sec", "p50_track_sec", "p99_track_sec", "peak_rss_mb", "disk_mb"]
+    width = max(len(name) for name in results) + 2
+    print("scenario".ljust(width) + "".join(column.rjust(16) for column in columns))
+    for name, metrics in results.items():
+        print(name.ljust(width) + "".join(format_value(metrics.get(column)).rjust(16) for column in columns))
+        previous = (baseline or {}).get(name)
+        if previous:
+            changes = []
+            for column in columns[1:]:
+                old, new = previous.get(column), metrics.get(column)
+                if old and new is not None:
+                    change = (new - old) / old * 100
+                    better = change > 0 if column in HIGHER_IS_BETTER else change < 0
+                    changes.append(f"{change:+.1f}%{'' if abs(change) < 5 else (' better' if better else ' worse')}".rjust(16))
+                else:
+                    changes.append("-".rjust(16))
+            print("  vs baseline".ljust(width) + " " * 16 + "".join(changes))
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end throughput benchmarks against a local mock API and CDN")
+    parser.add_argument("--scenario", action="append", help="Only run this scenario (can be repeated)")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with results saved by an earlier --output")
+    parser.add_argument("--list", action="store_true", help="List the scenarios")
+    parser.add_argument("--keep", action="store_true", help="Keep the downloaded files of every scenario")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(json.loads(args.child))
+        return
+    if args.list:
+        for scenario in SCENARIOS:
+            print(scenario["name"])
+        return
+
+    scenarios = [scenario for scenario in SCENARIOS if not args.scenario or scenario["name"] in args.scenario]
+    results = {}
+    for scenario in scenarios:
+        print(f"Running {scenario['name']} ...", flush=True)
+        results[scenario["name"]] = run_scenario(scenario, args.keep)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    print()
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
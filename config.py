@@ -1,3 +1,4 @@
+import os
 import re
 
 CUSTOM_HEADER = {
@@ -13,3 +14,83 @@ PURR_HEADER = {
 }
 
 NAME_SANITIZE_REGEX = re.compile(r"[<>:\"\/\\|?*]")
+
+
+# Can point somewhere else, e.g. at the mock server of the benchmarks
+API_BASE_URL = os.environ.get("SPDL_API_BASE_URL", "https://api.spotidownloader.com")
+
+# (connect, read) timeout in seconds applied to every request unless overridden
+REQUEST_TIMEOUT = (10, 60)
+
+# Minimum number of keep-alive connections kept per host
+POOL_SIZE = 10
+
+# Upper bound for cover art kept in memory (bytes)
+COVER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Tracks below this bitrate (kbps) are saved to low_quality/
+HIGH_QUALITY_BITRATE = 320
+
+# What to do with low quality sources, detected up front with a small Range request:
+# "all" downloads them into low_quality/, "high" skips them, "defer" downloads them after everything else
+QUALITY_POLICIES = ("all", "high", "defer")
+
+# Order in which the new tracks of a playlist are downloaded: grouped by album (smaller albums first), or as listed
+DOWNLOAD_ORDERS = ("album", "playlist")
+
+# Download links are resolved this many tracks ahead of the one being downloaded ...
+PREFETCH_DEPTH = 2
+# ... and resolved again if they are older than this (seconds) by the time they are used
+LINK_MAX_AGE = 120
+# Track metadata (not the download links) is cached this long (seconds), when there is a cache dir
+TRACK_METADATA_TTL = 30 * 24 * 3600
+
+# Free space (bytes) reserved in the ID3 tag of every file, so retagging (track numbers, covers, metadata)
+# rewrites the tag in place instead of the whole file
+TAG_PADDING = 64 * 1024
+
+# Pages of a playlist listing requested at once, once the page size is known
+LISTING_CONCURRENCY = 4
+
+# Requests per second and burst size allowed towards each upstream host
+RATE_LIMITS = {"api": (10, 10), "audio": (5, 5), "cover": (10, 10)}
+# Retries for throttled (429), failing (5xx) or dropped requests, with exponential backoff and jitter
+HTTP_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# Hedged requests: a GET to one of these hosts that has no response after the HEDGE_PERCENTILE latency of the
+# host's last HEDGE_WINDOW requests (and at least HEDGE_MIN_DELAY seconds) is sent a second time, and whichever
+# answers first is used. At most HEDGE_MAX_RATIO of the requests are hedged.
+HEDGE_HOSTS = ("api", "audio")
+HEDGE_PERCENTILE = 0.95
+HEDGE_WINDOW = 200
+HEDGE_MIN_DELAY = 0.05
+HEDGE_MAX_RATIO = 0.05
+
+# Tokens are only accepted for this many seconds, a new one is requested a little before that
+TOKEN_MAX_AGE = 540
+TOKEN_REFRESH_MARGIN = 30
+
+# Progress journal records are fsynced in batches of this many, or at least this often (seconds)
+JOURNAL_BATCH = 32
+JOURNAL_FLUSH_INTERVAL = 1.0
+
+# Size assumed for a track in a plan (about 3.5 minutes at 320kbps) when no downloaded tracks tell better
+PLAN_TRACK_BYTES = 8 * 1024 * 1024
+
+# Daemon mode: every sync.json entry is synced this often (seconds, unless the entry sets "interval" in minutes),
+# give or take this fraction, and sync.json is checked for changes this often (seconds)
+DAEMON_INTERVAL = 30 * 60
+DAEMON_JITTER = 0.1
+DAEMON_RELOAD_INTERVAL = 30
+# Port of the daemon's control endpoint on localhost
+DAEMON_PORT = 8765
+
+# How often (seconds) the Prometheus metrics file is rewritten during a run
+METRICS_INTERVAL = 15
+
+# The progress line is redrawn at most this often (seconds) on a terminal,
+# and written as a new line this often when the output is redirected
+PROGRESS_INTERVAL = 0.2
+PROGRESS_LOG_INTERVAL = 10
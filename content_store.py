@@ -0,0 +1,75 @@
+import os
+import shutil
+import logging
+import threading
+from mutagen.mp3 import MP3
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+# Linux ioctl that makes destination share the data blocks of source (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# Tracks shared by several playlists are downloaded once into <store>/<id[:2]>/<id>.mp3
+# and every playlist folder gets a hard link (or reflink, or copy) of that file.
+_store_dir = None
+_locks = {}
+_locks_lock = threading.Lock()
+
+def configure(store_dir=None):
+    global _store_dir
+    _store_dir = os.path.abspath(store_dir) if store_dir else None
+    if _store_dir:
+        os.makedirs(_store_dir, exist_ok=True)
+
+def enabled():
+    return _store_dir is not None
+
+def path_for(track_id):
+    return os.path.join(_store_dir, track_id[:2], f"{track_id}.mp3")
+
+def temp_path_for(track_id):
+    return os.path.join(_store_dir, track_id[:2], f"temp_{track_id}.mp3")
+
+def lock_for(track_id):
+    # Playlists sharing a track may reach it at the same time, only one of them downloads it
+    with _locks_lock:
+        return _locks.setdefault(track_id, threading.Lock())
+
+def bitrate_of(track_id):
+    return MP3(path_for(track_id)).info.bitrate / 1000
+
+def reflink(source, destination):
+    # destination must not exist: opening it for writing would truncate whatever it is, maybe source itself
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(source, "rb") as src, open(destination, "xb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+
+def link_file(source, destination):
+    """Makes destination a hard link of source, falling back to a reflink and then a plain copy
+    (e.g. across file systems). Returns the method that was used.
+    The link is made next to destination and moved over it, an existing destination is never written to."""
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return "hardlink" # Linked already (renaming another link of the same file over it would do nothing)
+    temp_path = f"{destination}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    for method, make_link in (("hardlink", os.link), ("reflink", reflink)):
+        try:
+            make_link(source, temp_path)
+        except OSError:
+            continue
+        os.replace(temp_path, destination)
+        return method
+    shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+    logging.info(f"Could not link {source}, copied it to {destination} instead")
+    return "copy"
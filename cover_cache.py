@@ -0,0 +1,108 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from config import COVER_CACHE_MAX_BYTES
+from http_client import cover_get
+from utils import write_atomic
+from metrics import timed, count
+
+class CoverCache:
+    """LRU of cover art bytes keyed by URL, optionally backed by a content-addressed
+    store on disk (<cache_dir>/covers) that persists across runs."""
+
+    def __init__(self, max_bytes=COVER_CACHE_MAX_BYTES, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.store_dir = os.path.join(cache_dir, "covers") if cache_dir else None
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def get(self, url):
+        while True:
+            with self._lock:
+                data = self._entries.get(url)
+                if data is not None:
+                    self._entries.move_to_end(url)
+                    count("cover_cache", source="memory")
+                    return data
+                event = self._inflight.get(url)
+                owner = event is None
+                if owner:
+                    event = self._inflight[url] = threading.Event()
+            if owner:
+                break
+            # Another worker is already fetching this cover, wait for it instead of refetching
+            event.wait()
+
+        try:
+            data = self.load(url)
+            if data is None:
+                with timed("cover_fetch"):
+                    response = cover_get(url)
+                    data = response.content
+                count("cover_cache", source="fetched")
+                count("bytes", len(data), kind="cover")
+                if response.status_code != 200:
+                    return data
+                self.store(url, data)
+            else:
+                count("cover_cache", source="disk")
+            self.remember(url, data)
+            return data
+        finally:
+            with self._lock:
+                self._inflight.pop(url).set()
+
+    def remember(self, url, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if url in self._entries:
+                return
+            self._entries[url] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    # On disk, covers are stored once under their sha256 (objects/ab/abcd...) and
+    # urls/<sha1 of url> points at the digest, so albums sharing art share the file.
+    def url_path(self, url):
+        return os.path.join(self.store_dir, "urls", hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def object_path(self, digest):
+        return os.path.join(self.store_dir, "objects", digest[:2], digest)
+
+    def load(self, url):
+        if not self.store_dir:
+            return None
+        try:
+            with open(self.url_path(url)) as f:
+                digest = f.read().strip()
+            with open(self.object_path(digest), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != digest:
+            return None
+        return data
+
+    def store(self, url, data):
+        if not self.store_dir:
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            write_atomic(object_path, data)
+        write_atomic(self.url_path(url), digest.encode("ascii"))
+
+cover_cache = CoverCache()
+
+def configure(cache_dir=None, max_bytes=COVER_CACHE_MAX_BYTES):
+    global cover_cache
+    cover_cache = CoverCache(max_bytes=max_bytes, cache_dir=cache_dir)
+
+def get_cover(url):
+    return cover_cache.get(url)
@@ -0,0 +1,235 @@
+"""Keeps spdl running and syncs every entry of sync.json on its own schedule.
+
+HTTP sessions, the token, the cover/metadata caches and the folder indexes stay warm between syncs, and
+playlists whose metadata reports no change are not listed again (see snapshots.py). A small HTTP endpoint
+on localhost reports the status and starts syncs on demand:
+
+    GET  /status                  entries with their last and next sync
+    POST /sync                    sync every entry now
+    POST /sync?link=...|name=...  sync one entry now
+"""
+import os
+import json
+import time
+import heapq
+import random
+import signal
+import logging
+import threading
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from config import DAEMON_INTERVAL, DAEMON_JITTER, DAEMON_PORT, DAEMON_RELOAD_INTERVAL
+from sync import read_sync_file, sync_entries
+from metrics import count
+from utils import echo
+
+def timestamp(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds)) if seconds else None
+
+class Schedule:
+    """Entries of the sync file keyed by link, in a priority queue ordered by when they are due next
+    and, among entries due at the same time, by their priority (higher first)."""
+
+    def __init__(self, interval=DAEMON_INTERVAL, jitter=DAEMON_JITTER):
+        self.interval = interval
+        self.jitter = jitter
+        self.entries = {}
+        self.queue = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.started = time.time()
+
+    def load(self, entries):
+        # New entries are due right away, removed ones are dropped, changed ones keep their schedule
+        with self.condition:
+            links = set()
+            for data, set_trackname_convention in entries:
+                link = data['link']
+                links.add(link)
+                entry = self.entries.get(link)
+                new = entry is None
+                if new:
+                    entry = self.entries[link] = {"runs": 0, "last_started": None, "last_finished": None, "last_error": None, "running": False, "rerun": False}
+                entry["data"] = data
+                entry["convention"] = set_trackname_convention
+                entry["interval"] = data.get("interval", self.interval / 60) * 60
+                entry["priority"] = data.get("priority", 0)
+                if new:
+                    self.push(entry, link, time.time())
+            for link in set(self.entries) - links:
+                del self.entries[link]
+            self.condition.notify()
+
+    def push(self, entry, link, due):
+        # Earlier queue items of the entry become stale, they are skipped when they come up
+        entry["due"] = due
+        heapq.heappush(self.queue, (due, -entry["priority"], next(self.order), link))
+
+    def reschedule(self, link):
+        with self.condition:
+            entry = self.entries.get(link)
+            if entry is not None and entry["rerun"]: # Triggered while it was syncing
+                entry["rerun"] = False
+                self.push(entry, link, time.time())
+            elif entry is not None:
+                # The jitter keeps entries with the same interval (and several daemons) from polling in lockstep
+                spread = random.uniform(1 - self.jitter, 1 + self.jitter)
+                self.push(entry, link, time.time() + entry["interval"] * spread)
+
+    def trigger(self, link=None, name=None):
+        # Makes the matching entries (all by default) due now, returns their links
+        with self.condition:
+            links = [
+                entry_link for entry_link, entry in self.entries.items()
+                if (link is None or entry_link == link) and (name is None or entry["data"].get("name") == name)
+            ]
+            now = time.time()
+            for entry_link in links:
+                entry = self.entries[entry_link]
+                if entry["running"]:
+                    entry["rerun"] = True
+                elif entry["due"] > now:
+                    self.push(entry, entry_link, now)
+            self.condition.notify()
+            return links
+
+    def wait_due(self, timeout):
+        # Entries that are due, by priority, as soon as there are any (or an empty list after timeout)
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                due = []
+                while self.queue and self.queue[0][0] <= now:
+                    item_due, _, _, link = heapq.heappop(self.queue)
+                    entry = self.entries.get(link)
+                    if entry is not None and entry["due"] == item_due:
+                        due.append(link)
+                if due:
+                    return due
+                while self.queue and self.stale(self.queue[0]):
+                    heapq.heappop(self.queue)
+                wake = min(self.queue[0][0] if self.queue else deadline, deadline)
+                if now >= deadline:
+                    return []
+                self.condition.wait(wake - now)
+
+    def stale(self, item):
+        entry = self.entries.get(item[3])
+        return entry is None or entry["due"] != item[0]
+
+    def run(self, links, workers, quality):
+        with self.condition:
+            batch = [(link, self.entries[link]) for link in links if link in self.entries]
+            for _, entry in batch:
+                entry["running"] = True
+                entry["last_started"] = time.time()
+        try:
+            sync_entries([(entry["data"], entry["convention"]) for _, entry in batch], workers, quality)
+            error = None
+        except Exception as e:
+            logging.error(f"Sync of {len(batch)} entries failed --> {e}")
+            echo(f"Sync failed --> {e}")
+            error = str(e)
+        with self.condition:
+            for link, entry in batch:
+                entry["running"] = False
+                entry["last_finished"] = time.time()
+                entry["last_error"] = error
+                entry["runs"] += 1
+        count("daemon_syncs", len(batch), result="failed" if error else "ok")
+        for link, _ in batch:
+            self.reschedule(link)
+
+    def status(self):
+        with self.condition:
+            return {
+                "started": timestamp(self.started),
+                "entries": [
+                    {
+                        "name": entry["data"].get("name"),
+                        "link": link,
+                        "priority": entry["priority"],
+                        "interval": entry["interval"],
+                        "running": entry["running"],
+                        "runs": entry["runs"],
+                        "last_started": timestamp(entry["last_started"]),
+                        "last_finished": timestamp(entry["last_finished"]),
+                        "last_error": entry["last_error"],
+                        "next_sync": None if entry["running"] else timestamp(entry["due"]),
+                    }
+                    for link, entry in sorted(self.entries.items(), key=lambda item: item[1]["due"])
+                ],
+            }
+
+class ControlHandler(BaseHTTPRequestHandler):
+    schedule = None
+
+    def log_message(self, format, *args):
+        logging.info("Control request: " + format % args)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == "/status":
+            return self.send_json(200, self.schedule.status())
+        self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/sync":
+            return self.send_json(404, {"error": "not found"})
+        query = parse_qs(url.query)
+        link = query.get("link", [None])[0]
+        name = query.get("name", [None])[0]
+        triggered = self.schedule.trigger(link, name)
+        if not triggered:
+            return self.send_json(404, {"error": "no matching entry"})
+        self.send_json(202, {"triggered": triggered})
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, indent=2).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_control_server(schedule, port=DAEMON_PORT):
+    handler = type("BoundControlHandler", (ControlHandler,), {"schedule": schedule})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def stop_on_sigterm(signum, frame):
+    # Service managers stop the daemon with SIGTERM, handled like Ctrl+C so the exit path still runs
+    raise KeyboardInterrupt
+
+def run_daemon(sync_file, workers=1, quality="all", interval=DAEMON_INTERVAL, port=DAEMON_PORT):
+    schedule = Schedule(interval)
+    schedule.load(read_sync_file(sync_file))
+    loaded = os.stat(sync_file).st_mtime_ns
+    server = start_control_server(schedule, port)
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+    print(f"Syncing {len(schedule.entries)} entries every {interval / 60:g} minutes, control endpoint on http://127.0.0.1:{server.server_address[1]}")
+    logging.info(f"Daemon started for {sync_file}")
+    try:
+        while True:
+            due = schedule.wait_due(DAEMON_RELOAD_INTERVAL)
+            # Entries added to or removed from sync.json are picked up without a restart
+            try:
+                mtime = os.stat(sync_file).st_mtime_ns
+                if mtime != loaded:
+                    schedule.load(read_sync_file(sync_file))
+                    loaded = mtime
+                    logging.info(f"Reloaded {sync_file}")
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not reload {sync_file} --> {e}")
+            if due:
+                print(f"\n[{timestamp(time.time())}] Syncing {len(due)} entries")
+                schedule.run(due, workers, quality)
+    except KeyboardInterrupt:
+        print("\nStopping the daemon")
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,155 +1,285 @@
 import os
 import re
-import requests
 import logging
-from config import PURR_HEADER
+import time
+import threading
+from queue import Queue
+from contextlib import closing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC, error, TRCK, TIT2, TALB, TPE1, TDRC
-from config import NAME_SANITIZE_REGEX
-from spotify_api import get_track_info, get_playlist_info
-from utils import resolve_path, get_token, resolve_path
-
-def attach_track_metadata(trackname, outpath, is_high_quality, metadata, track_number=0):
-    trackname = re.sub(NAME_SANITIZE_REGEX, "_", trackname)
-    filepath = os.path.join(outpath, f"{trackname}.mp3") if is_high_quality else os.path.join(outpath, "low_quality", f"{trackname}.mp3")
-    try:
-        # raise error("Testing")
-        audio = MP3(filepath, ID3=ID3)
-    except error as e:
-        logging.error(f"Error loading MP3 file from {filepath} --> {e}")
-        print(f"\tError loading MP3 file --> {e}")
-        return
-
-    if audio.tags is None:
-        try:
-            title = metadata['title']
-            artist = metadata['artists']
-            album = metadata['album']
-            year = metadata['releaseDate']
-            # audio.tags = ID3()
-            audio.add_tags()
-            audio.tags.add(TIT2(encoding=3, text=title))
-            audio.tags.add(TPE1(encoding=3, text=artist))
-            audio.tags.add(TALB(encoding=3, text=album))
-            audio.tags.add(TDRC(encoding=3, text=year))
-        except error as e:
-            logging.error(f"Error adding ID3 tags to {filepath} --> {e}")
-            print(f"\tError adding ID3 tags --> {e}")
-            return 
-
-    cover_art = requests.get(metadata['cover']).content
-    audio.tags.add(
-        APIC(
-            encoding=1,
-            mime='image/jpeg',
-            type=3,
-            desc=u'Cover',
-            data=cover_art
-        )
-    )
-    # Add track number
-    # print(f"\t Adding track number: {track_number}")
-    if track_number > 0:
-        audio.tags.add(TRCK(encoding=3, text=str(track_number)))
-    
-    audio.save(filepath, v2_version=3, v1=2)
+from mutagen.id3 import ID3
+from config import HIGH_QUALITY_BITRATE, PREFETCH_DEPTH, LISTING_CONCURRENCY
+from cover_cache import get_cover
+from transfer import download_to_file, probe_remote_bitrate
+from tagging import build_tags, save_tags, update_tags
+from library_index import library_for, library_folders
+from scheduler import order_tracks, wait_for_window
+import content_store
+from journal import Journal, journal_path, RESOLVED, DOWNLOADED, TAGGED, DONE, FINISHED
+from track_cache import cached_metadata, cached_link, forget_link
+from spotify_api import get_track_info, get_playlist_metadata, iter_playlist_tracks
+from snapshots import renumbered
+from rate_limit import backoff_delay
+from metrics import timed, count
+from token_manager import tokens
+from utils import resolve_path, echo, buffered_call, track_id_from_link, make_unique_song_objects, output_mode, sanitize_name
+from progress import ProgressRenderer
+
+# save_audio results for tracks rejected by the quality policy before downloading
+SKIPPED = "skipped"
+DEFERRED = "deferred"
+# save_audio result for a track that is already in the folder (None means the download failed)
+EXISTS = "exists"
+
+def track_outcome(result):
+    # What a download_playlist_track result counts as in the progress and summaries
+    if result in (SKIPPED, DEFERRED):
+        return result
+    if result == EXISTS:
+        return "skipped"
+    return "failed" if result is None else "downloaded"
 
-def save_audio(trackname, link, outpath):
-    trackname = re.sub(NAME_SANITIZE_REGEX, "_", trackname)
+def retag_library(root):
+    """Rewrites the title, artists, album, release date and cover of every indexed track under root, from the
+    cached track metadata (fetched once when it is missing). Tracks without a Spotify track ID in their tags are
+    left alone. Files written with a padding reserve take the new tag in place, without moving the audio."""
+    for folder in library_folders(root):
+        library = library_for(folder)
+        library.refresh()
+        results = {"in place": 0, "rewritten": 0, "no track ID": 0, "failed": 0}
+        for filepath, track_id in library.tracks():
+            if not track_id:
+                results["no track ID"] += 1
+                continue
+            try:
+                metadata = cached_metadata(track_id)
+                if metadata is None:
+                    _, metadata = resolve_track(f"https://open.spotify.com/track/{track_id}", track_id)
+                    forget_link(track_id)
+                with timed("tag_save"):
+                    in_place = update_tags(filepath, metadata, cover_art=get_cover(metadata['cover']))
+            except Exception as e:
+                logging.error(f"Could not retag {filepath} --> {e}")
+                echo(f"\tCould not retag {os.path.basename(filepath)} --> {e}")
+                results["failed"] += 1
+                continue
+            result = "in place" if in_place else "rewritten"
+            count("retagged", result=result.replace(" ", "_"))
+            results[result] += 1
+        summary = ", ".join(f"{number} {result}" for result, number in results.items() if number)
+        print(f"Retagged {folder}: {summary or 'no tracks'}")
+        logging.info(f"Retagged {folder}: {summary or 'no tracks'}")
+
+def final_track_path(trackname, outpath, bitrate):
+    # Returns where a track of this bitrate belongs and whether it is high quality
+    if bitrate >= HIGH_QUALITY_BITRATE:
+        return os.path.join(outpath, f"{trackname}.mp3"), True
     low_quality_path = os.path.join(outpath, "low_quality")
-    
-    if os.path.exists(os.path.join(outpath, f"{trackname}.mp3")) or \
-       os.path.exists(os.path.join(low_quality_path, f"{trackname}.mp3")):
-        logging.info(f"{trackname} already exists in the directory ({outpath}). Skipping download!")
-        print("\tThis track already exists in the directory. Skipping download!")
-        return None
-    
-    audio_response = requests.get(link, headers=PURR_HEADER)
+    if not os.path.exists(low_quality_path):
+        os.makedirs(low_quality_path)
+    return os.path.join(low_quality_path, f"{trackname}.mp3"), False
+
+def link_stored_track(trackname, track_id, outpath, bitrate=None):
+    if bitrate is None:
+        bitrate = content_store.bitrate_of(track_id)
+    final_path, is_high_quality = final_track_path(trackname, outpath, bitrate)
+    method = content_store.link_file(content_store.path_for(track_id), final_path)
+    logging.info(f"{trackname} linked from the track store ({method})")
+    library_for(outpath).record(final_path, track_id, bitrate)
+    return is_high_quality
+
+def place_track(trackname, temp_file, outpath, bitrate, track_id=None, tagged=True):
+    # Moves a complete download into place (through the track store if it was downloaded for it).
+    # Returns whether the track is high quality.
+    if content_store.enabled() and track_id is not None and temp_file == content_store.temp_path_for(track_id):
+        os.replace(temp_file, content_store.path_for(track_id))
+        return link_stored_track(trackname, track_id, outpath, bitrate)
+    final_path, is_high_quality = final_track_path(trackname, outpath, bitrate)
+    os.replace(temp_file, final_path)
+    library_for(outpath).record(final_path, track_id, bitrate, tagged=tagged)
+    return is_high_quality
+
+def skip_existing(trackname, outpath, track_id=None, journal=None):
+    # Reports and returns whether the track is already in the folder
+    if not library_for(outpath).find(track_id, sanitize_name(trackname)):
+        return False
+    logging.info(f"{trackname} already exists in the directory ({outpath}). Skipping download!")
+    echo("\tThis track already exists in the directory. Skipping download!")
+    count("tracks", result="exists")
+    if journal:
+        journal.record(trackname, DONE)
+    return True
+
+def save_audio(trackname, link, outpath, metadata=None, track_number=0, quality="all", track_id=None, journal=None):
+    # With metadata, the tags are written while the audio streams in, so the file
+    # hits the disk once and is moved into place tagged and complete.
+    # Returns whether the saved track is high quality, None if the download failed, EXISTS if the
+    # track is already in the folder, or SKIPPED / DEFERRED when the quality policy rejected a
+    # low quality source up front.
+    # link can be a function returning the download link, called only once the audio is needed.
+    # With a journal, every state the track reaches is recorded under its unsanitized name.
+    def note(state, **data):
+        if journal:
+            journal.record(journal_key, state, **data)
+
+    journal_key = trackname
+    trackname = sanitize_name(trackname)
+
+    if skip_existing(journal_key, outpath, track_id, journal):
+        return EXISTS
 
-    if audio_response.status_code == 200:
+    # With a track store, the file is downloaded once into the store and linked into every folder
+    use_store = content_store.enabled() and track_id is not None
+    if use_store and os.path.exists(content_store.path_for(track_id)):
+        echo("\tAlready downloaded for another playlist, linking it!")
+        is_high_quality = link_stored_track(trackname, track_id, outpath)
+        count("tracks", result="linked")
+        note(DONE)
+        return is_high_quality
+
+    if callable(link):
+        link = link()
+
+    if quality != "all":
+        with timed("quality_probe"):
+            bitrate = probe_remote_bitrate(link)
+        if bitrate is not None and bitrate < HIGH_QUALITY_BITRATE:
+            if quality == "defer":
+                logging.info(f"{trackname} is only available in {bitrate:.0f}kbps. Deferring download!")
+                echo(f"\tOnly available in {bitrate:.0f}kbps. Deferring download to the end of the run!")
+                count("tracks", result="deferred")
+                return DEFERRED
+            logging.info(f"{trackname} is only available in {bitrate:.0f}kbps. Skipping download!")
+            echo(f"\tOnly available in {bitrate:.0f}kbps. Skipping download!")
+            count("tracks", result="low_quality")
+            note(SKIPPED)
+            return SKIPPED
+
+    make_tags = None
+    if metadata is not None:
+        cover_art = get_cover(metadata['cover'])
+        make_tags = lambda source_tags: build_tags(metadata, track_number, cover_art, source_tags, track_id)
+
+    def downloaded(temp_file, bitrate):
+        note(DOWNLOADED, temp=temp_file, size=os.path.getsize(temp_file), bitrate=bitrate, metadata=metadata)
+        if make_tags is not None: # The tags went in while the audio streamed
+            note(TAGGED)
+
+    if use_store:
+        with content_store.lock_for(track_id):
+            if os.path.exists(content_store.path_for(track_id)): # Another playlist got it while we were waiting
+                is_high_quality = link_stored_track(trackname, track_id, outpath)
+                count("tracks", result="linked")
+                note(DONE)
+                return is_high_quality
+            temp_file = content_store.temp_path_for(track_id)
+            os.makedirs(os.path.dirname(temp_file), exist_ok=True)
+            status_code, bitrate = download_to_file(link, temp_file, make_tags)
+            if status_code == 200:
+                downloaded(temp_file, bitrate)
+                is_high_quality = place_track(trackname, temp_file, outpath, bitrate, track_id)
+    else:
         temp_file = os.path.join(outpath, f"temp_{trackname}.mp3")
-        with open(temp_file, "wb") as file:
-            file.write(audio_response.content)
-        
-        # Check bitrate
-        audio = MP3(temp_file)
-        bitrate = audio.info.bitrate / 1000  # Convert to kbps
-        
-        if bitrate >= 320:
-            final_path = os.path.join(outpath, f"{trackname}.mp3")
-            is_high_quality = True
-        else:
-            if not os.path.exists(low_quality_path):
-                os.makedirs(low_quality_path)
-            final_path = os.path.join(low_quality_path, f"{trackname}.mp3")
-            is_high_quality = False
-        
-        os.rename(temp_file, final_path)
+        status_code, bitrate = download_to_file(link, temp_file, make_tags)
+        if status_code == 200:
+            downloaded(temp_file, bitrate)
+            is_high_quality = place_track(trackname, temp_file, outpath, bitrate, track_id, tagged=make_tags is not None)
+
+    if status_code == 200:
         # print(f"\t Saved {trackname} ({bitrate:.0f}kbps) to {'current' if is_high_quality else 'low_quality'} folder")
+        count("tracks", result="downloaded")
+        note(DONE)
         return is_high_quality
 
     else:
-        logging.error(f"Failed to download {trackname}. Status code: {audio_response.status_code}")
-        print(f"\tFailed to download {trackname}. Status code: {audio_response.status_code}")
+        logging.error(f"Failed to download {trackname}. Status code: {status_code}")
+        echo(f"\tFailed to download {trackname}. Status code: {status_code}")
         return None
 
-def check_track_playlist(link, outpath, create_folder, trackname_convention, token):
+def check_track_playlist(link, outpath, create_folder, trackname_convention, token, workers=1, quality="all"):
     # from utils import resolve_path  # local import to avoid circular dependency
     resolve_path(outpath)
     # if "/track/" in link:
     if re.search(r".*spotify\.com\/(?:intl-[a-zA-Z]{2}\/)?track\/", link):
-        download_track(link, outpath, trackname_convention, token)
+        return download_track(link, outpath, trackname_convention, token, quality=quality)
     # elif "/playlist/" in link:
     elif re.search(r".*spotify\.com\/playlist\/", link):
-        download_playlist_tracks(link, outpath, create_folder, trackname_convention, token)
+        download_playlist_tracks(link, outpath, create_folder, trackname_convention, token, workers=workers, quality=quality)
     # elif "/album/" in link:
     elif re.search(r".*spotify\.com\/album\/", link):
-        download_playlist_tracks(link, outpath, create_folder, trackname_convention, mode='album', token=token)
+        download_playlist_tracks(link, outpath, create_folder, trackname_convention, mode='album', token=token, workers=workers, quality=quality)
     else:
         logging.error(f"{link} is not a valid Spotify track or playlist link")
         print(f"\n{link} is not a valid Spotify track or playlist link")
 
-def download_track(track_link, outpath, trackname_convention, token, max_attempts=3):
-    print("\nTrack link identified")
-
-    resp = get_track_info(track_link, token)
+def resolve_track(song_link, track_id):
+    """Returns the download link and metadata of a track. A link resolved less than LINK_MAX_AGE seconds ago
+    (ahead of time by the prefetch, or for an earlier pass over the playlist) is used again."""
+    link = cached_link(track_id)
+    metadata = cached_metadata(track_id) if link is not None else None
+    if metadata is not None:
+        return link, metadata
+    token = tokens.get()
+    resp = get_track_info(song_link, token)
     if resp["statusCode"] == 403:
-        print("\tStatus code 403: Unauthorized access. Please provide a new token.")
-        logging.error("Token expired, request new token")
-        token = get_token(reset=True) # Resets the cache
-        resp = get_track_info(track_link, token)  # Retry with new token
-    if resp['success'] == False:
-        print(f"Error: {resp['message']}")
-        logging.error(f"Error: {resp['message']}")
-        return
-
-    trackname = f"{resp['metadata']['title']} - {resp['metadata']['artists']}"
+        echo("\tStatus code 403: Unauthorized access. Please provide a new token.")
+        logging.error("Token expired. Requested new token")
+        token = tokens.refresh(token)
+        resp = get_track_info(song_link, token)  # Retry with new token
+    if not resp.get('success'):
+        raise ValueError(resp.get('message', f"Could not resolve {song_link}"))
+    return resp['link'], resp['metadata']
+
+def download_track(track_link, outpath, trackname_convention, token, max_attempts=3, quality="all"):
+    echo("\nTrack link identified")
+
+    track_id = track_id_from_link(track_link)
+    # With cached metadata, the link is only resolved if the track still has to be downloaded
+    metadata = cached_metadata(track_id)
+    link = lambda: resolve_track(track_link, track_id)[0]
+    if metadata is None:
+        try:
+            link, metadata = resolve_track(track_link, track_id)
+        except ValueError as e:
+            print(f"Error: {e}") # Failures are shown in quiet mode too
+            logging.error(f"Error: {e}")
+            count("tracks", result="failed")
+            return None
+
+    trackname = f"{metadata['title']} - {metadata['artists']}"
     if trackname_convention == 2:
-        trackname = f"{resp['metadata']['artists']} - {resp['metadata']['title']}"
+        trackname = f"{metadata['artists']} - {metadata['title']}"
+
+    if skip_existing(trackname, outpath, track_id):
+        return EXISTS
+    if wait_for_window(): # The link resolved with the metadata has expired meanwhile
+        forget_link(track_id)
+        link = lambda: resolve_track(track_link, track_id)[0]
 
-    print(f"\nDownloading {trackname} to ({outpath})")
+    echo(f"\nDownloading {trackname} to ({outpath})")
+    result = None
     for attempt in range(max_attempts):
         try:
             # raise Exception("Testing")
-            is_high_quality = save_audio(trackname, resp['link'], outpath)
-            if is_high_quality is not None:  # Check if download was successful
-                # cover_art = requests.get(resp['metadata']['cover']).content
-                attach_track_metadata(trackname, outpath, is_high_quality, resp['metadata'])
-            break
+            # A single track has nothing to be deferred behind, so it is downloaded right away
+            result = save_audio(trackname, link, outpath, metadata, quality="all" if quality == "defer" else quality, track_id=track_id)
         except Exception as e:
             logging.error(f"Attempt {attempt+1}/{max_attempts} - {trackname} --> {e}")
-            print(f"\tAttempt {attempt+1}/{max_attempts} failed with error: ", e)
+            echo(f"\tAttempt {attempt+1}/{max_attempts} failed with error: ", e)
+        if result is not None: # Saved, already there or rejected by the quality policy
+            break
+        # The link may be what failed, the next attempt resolves a new one
+        forget_link(track_id)
+        link = lambda: resolve_track(track_link, track_id)[0]
+        if attempt + 1 < max_attempts:
+            count("track_retries")
+            time.sleep(backoff_delay(attempt))
+    else:
+        print(f"Could not download {trackname} after {max_attempts} attempts")
+        count("tracks", result="failed")
     remove_empty_files(outpath)
-
-def check_existing_tracks(song_list_dict, outpath):
-    existing_tracks = os.listdir(outpath)
-    for track in existing_tracks:
-        if track.endswith(".mp3"):
-            track = track.split(".mp3")[0]
-            if song_list_dict.get(track):
-                song_list_dict.pop(track)
-    
-    return song_list_dict
+    return result
 
 def cleanup(outpath):
     for file in os.listdir(outpath):
@@ -165,47 +295,291 @@ def remove_empty_files(outpath):
     if os.path.exists(low_quality_path):
         cleanup(low_quality_path)
 
-def download_playlist_tracks(playlist_link, outpath, create_folder, trackname_convention, token, max_attempts=3, mode='playlist'):
+def prepare_playlist(playlist_link, outpath, create_folder, mode, token):
+    # Returns the playlist folder (created if needed), its name and the playlist metadata
     # print(f"\n{mode[0].upper()}{mode[1:]} link identified")
-    print(f"\n{mode.capitalize()} link identified")
-    song_list_dict, playlist_name_old = get_playlist_info(playlist_link, trackname_convention, mode, token)
-    playlist_name = re.sub(NAME_SANITIZE_REGEX, "_", playlist_name_old)
+    echo(f"\n{mode.capitalize()} link identified")
+    metadata = get_playlist_metadata(playlist_link, mode, token)
+    playlist_name_old = metadata['title']
+    playlist_name = sanitize_name(playlist_name_old)
     if (playlist_name != playlist_name_old):
-        print(f'\n"{playlist_name_old}" is not a valid folder name. Using "{playlist_name}" instead.')
+        echo(f'\n"{playlist_name_old}" is not a valid folder name. Using "{playlist_name}" instead.')
 
     if create_folder == True:
         outpath = os.path.join(outpath, playlist_name)
     resolve_path(outpath, playlist_folder=True)
+    return outpath, playlist_name, metadata
+
+def renumber_tracks(outpath, old_tracks, new_tracks):
+    # Rewrites the track number of the downloaded tracks whose position in the playlist changed
+    positions = renumbered(old_tracks, new_tracks)
+    renumbered_files = 0
+    for filepath, track_id in library_for(outpath).tracks() if positions else ():
+        position = positions.get(track_id)
+        if position is None:
+            continue
+        try:
+            with timed("tag_save"):
+                in_place = update_tags(filepath, track_number=position)
+        except Exception as e:
+            logging.error(f"Could not renumber {filepath} --> {e}")
+            continue
+        count("retagged", result="in_place" if in_place else "rewritten")
+        renumbered_files += 1
+    if renumbered_files:
+        echo(f"Updated the track number of {renumbered_files} downloaded track(s) whose position changed")
+
+def iter_new_tracks(playlist_link, outpath, trackname_convention, mode, metadata, concurrency=LISTING_CONCURRENCY):
+    """Yields, page by page as the listing arrives, the tracks that still have to be downloaded into outpath.
+    Tracks already in the folder's index are skipped before any Song is built for them."""
+    library = library_for(outpath)
+    library.refresh()
+    known_ids, known_names = library.contents()
+    seen_names = set()
+    seen_ids = set()
+    position = 1
+    # In a playlist the track number is the position, which changes for the tracks already downloaded too
+    on_change = (lambda old_tracks, new_tracks: renumber_tracks(outpath, old_tracks, new_tracks)) if mode == 'playlist' else None
+    for page in iter_playlist_tracks(playlist_link, mode, metadata, concurrency, on_change):
+        song_list_dict = make_unique_song_objects(page, trackname_convention, metadata['title'], mode, known_ids, position, seen_names, seen_ids)
+        position += len(page)
+        yield {trackname: song for trackname, song in song_list_dict.items() if trackname not in known_names}
+
+def open_journal(playlist_link, outpath, mode):
+    playlist_id = playlist_link.split("/")[-1].split("?")[0]
+    return Journal(journal_path(outpath, mode, playlist_id))
 
-    if os.path.exists(outpath):
-        song_list_dict = check_existing_tracks(song_list_dict, outpath)
+def finish_journaled_track(trackname, song, outpath, journal):
+    # Moves a track the journal saw fully downloaded into place, tagging it first if that did not happen yet.
+    # Returns False if the download is gone and the track has to be fetched again.
+    state, data = journal.state_of(trackname)
+    temp_file = data.get('temp')
+    if state not in (DOWNLOADED, TAGGED) or not os.path.exists(temp_file) or os.path.getsize(temp_file) != data['size']:
+        return False
+    track_id = track_id_from_link(song.link)
+    metadata = data.get('metadata')
+    if state == DOWNLOADED and metadata is not None:
+        audio = MP3(temp_file, ID3=ID3)
+        audio.tags = build_tags(metadata, song.track_number, get_cover(metadata['cover']), audio.tags, track_id)
+        with timed("tag_save"):
+            save_tags(audio.tags, temp_file)
+        journal.record(trackname, TAGGED, size=os.path.getsize(temp_file))
+    place_track(sanitize_name(trackname), temp_file, outpath, data['bitrate'], track_id, tagged=metadata is not None)
+    journal.record(trackname, DONE)
+    return True
+
+def finish_journaled_tracks(journal):
+    # Returns the tracks of the journaled run that are not done yet
+    remaining = {}
+    for trackname, song in journal.songs.items():
+        state, _ = journal.state_of(trackname)
+        if state in FINISHED:
+            continue
+        if finish_journaled_track(trackname, song, journal.run['outpath'], journal):
+            logging.info(f"{trackname} finished from the download of an interrupted run")
+            continue
+        remaining[trackname] = song
+    return remaining
+
+def journaled_pages(journal, pages):
+    # Passes the pages on while journaling them. Looks one page ahead so the listing
+    # is marked complete as soon as it is, not once the last page has been downloaded.
+    page = next(pages, None)
+    while page is not None:
+        journal.add_tracks(page)
+        following = next(pages, None)
+        if following is None:
+            journal.mark_listed()
+        yield page
+        page = following
+
+def start_playlist(playlist_link, outpath, create_folder, trackname_convention, mode, token, concurrency=LISTING_CONCURRENCY):
+    """Returns the run's journal, the playlist folder, its name and the new tracks page by page.
+    If an earlier run of this playlist was interrupted after listing it, it is picked up from its
+    journal without asking the API again; downloads it left complete are moved into place."""
+    journal = open_journal(playlist_link, outpath, mode)
+    if journal.resumable():
+        remaining = finish_journaled_tracks(journal)
+        if journal.listed:
+            run = journal.run
+            done = len(journal.songs) - len(remaining)
+            echo(f"\nResuming {run['name']} where the last run stopped: {done}/{len(journal.songs)} track(s) done")
+            return journal, run['outpath'], run['name'], iter([remaining])
+    outpath, playlist_name, metadata = prepare_playlist(playlist_link, outpath, create_folder, mode, token)
+    journal.start({"link": playlist_link, "mode": mode, "outpath": outpath, "name": playlist_name})
+    pages = iter_new_tracks(playlist_link, outpath, trackname_convention, mode, metadata, concurrency)
+    return journal, outpath, playlist_name, journaled_pages(journal, pages)
+
+def prepare_playlist_tracks(playlist_link, outpath, create_folder, trackname_convention, token, mode='playlist', concurrency=LISTING_CONCURRENCY):
+    # Returns the run's journal, the playlist folder, its name and all the tracks that still have to be downloaded into it
+    journal, outpath, playlist_name, pages = start_playlist(playlist_link, outpath, create_folder, trackname_convention, mode, token, concurrency)
+    song_list_dict = {}
+    for page in pages:
+        song_list_dict.update(page)
     if not song_list_dict:
-        print(f"\nAll tracks from {playlist_name} already exist in the directory ({outpath}).")
-        return
+        echo(f"\nAll tracks from {playlist_name} already exist in the directory ({outpath}).")
+        journal.finish()
+    return journal, outpath, playlist_name, song_list_dict
+
+def download_playlist_tracks(playlist_link, outpath, create_folder, trackname_convention, token, max_attempts=3, mode='playlist', workers=1, quality="all"):
+    journal, outpath, playlist_name, pages = start_playlist(playlist_link, outpath, create_folder, trackname_convention, mode, token)
+    download_pages(journal, outpath, playlist_name, pages, max_attempts, workers, quality)
+
+def download_planned_tracks(playlist_link, outpath, playlist_name, song_list_dict, mode='playlist', max_attempts=3, workers=1, quality="all"):
+    # Downloads the tracks a plan listed for the playlist, without listing it again (see plan.py)
+    resolve_path(outpath, playlist_folder=True)
+    journal = open_journal(playlist_link, outpath, mode)
+    journal.start({"link": playlist_link, "mode": mode, "outpath": outpath, "name": playlist_name})
+    echo(f"\n{mode.capitalize()} {playlist_name}: {len(song_list_dict)} track(s) planned")
+    return download_pages(journal, outpath, playlist_name, journaled_pages(journal, iter([song_list_dict])), max_attempts, workers, quality)
+
+def count_outcomes(outcomes, results):
+    # Like track_outcome, but tracks already in the folder are told apart from skipped ones
+    outcomes.update(EXISTS if result == EXISTS else track_outcome(result) for result in results if result != DEFERRED)
 
-    print(f"\nDownloading {len(song_list_dict)} new track(s) from {playlist_name} to ({outpath})")
-    print("-" * 40)
-    for index, trackname in enumerate(song_list_dict.keys(), 1):
-        print(f"{index}/{len(song_list_dict)}: {trackname}")
+def download_pages(journal, outpath, playlist_name, pages, max_attempts=3, workers=1, quality="all"):
+    # Returns how many tracks were downloaded, skipped, failed or found already in the folder
+    progress = ProgressRenderer(playlist_name)
+    outcomes = Counter()
+    try:
+        song_list_dict = {}
+        deferred = []
+        # Downloads start with the first page of the listing, while the next pages are still being fetched
+        for page in pages:
+            if not page:
+                continue
+            if not song_list_dict:
+                echo(f"\nDownloading new track(s) from {playlist_name} to ({outpath})")
+                echo("-" * 40)
+            start = len(song_list_dict)
+            song_list_dict.update(page)
+            progress.add(len(page))
+            tracknames = order_tracks(page.keys(), page)
+            results = download_tracks(tracknames, song_list_dict, outpath, playlist_name, max_attempts, workers, quality, progress, start, journal)
+            count_outcomes(outcomes, results)
+            deferred.extend(trackname for trackname, result in zip(tracknames, results) if result == DEFERRED)
+
+        if not song_list_dict:
+            echo(f"\nAll tracks from {playlist_name} already exist in the directory ({outpath}).")
+            journal.finish()
+            return outcomes
+
+        if deferred:
+            progress.message(f"\nDownloading {len(deferred)} deferred low quality track(s) from {playlist_name}\n" + "-" * 40)
+            results = download_tracks(order_tracks(deferred, song_list_dict), song_list_dict, outpath, playlist_name, max_attempts, workers, "all", progress, journal=journal)
+            count_outcomes(outcomes, results)
+
+        progress.close()
+        remove_empty_files(outpath)
+        journal.finish()
+        return outcomes
+    finally:
+        journal.close() # Whatever is still buffered, if the run did not get to the end
+
+def download_tracks(tracknames, song_list_dict, outpath, playlist_name, max_attempts, workers, quality, progress, start=0, journal=None):
+    # Returns the save_audio result of every track, in the order of tracknames, and reports each one to progress.
+    # start is the number of tracks of the playlist handled before these ones (for the progress numbering).
+    total = start + len(tracknames)
+    if workers <= 1:
+        # Even one track at a time, the next links are resolved while the current track transfers
+        results = []
+        with closing(prefetch_track_info(tracknames, song_list_dict)) as prefetched:
+            for (index, trackname), _ in zip(enumerate(tracknames, start + 1), prefetched):
+                args = (index, total, trackname, song_list_dict[trackname], outpath, playlist_name, max_attempts, quality, journal)
+                if output_mode() == "verbose": # Printed as it happens
+                    lines, result = [], download_playlist_track(*args)
+                else:
+                    lines, result = buffered_call(download_playlist_track, *args)
+                progress.report(lines, track_outcome(result))
+                results.append(result)
+        return results
+
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(buffered_playlist_track, index, total, trackname, song_list_dict[trackname], outpath, playlist_name, max_attempts, quality, journal)
+            for index, trackname in enumerate(tracknames, start + 1)
+        ]
+        # Each track's output is printed as one block, in playlist order
+        for future in futures:
+            lines, result = future.result()
+            progress.report(lines, track_outcome(result))
+            results.append(result)
+    return results
+
+def prefetch_track_info(tracknames, song_list_dict, depth=PREFETCH_DEPTH):
+    """Resolves the download links (and warms the cover cache) of upcoming tracks in a background
+    thread, at most depth tracks ahead. Yields every trackname, in order, once its link has been
+    resolved (or failed to), and download_playlist_track picks the link up from the track cache."""
+    resolved = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def resolve():
+        for trackname in tracknames:
+            if stop.is_set():
+                return
+            song = song_list_dict[trackname]
+            track_id = track_id_from_link(song.link)
+            if not (content_store.enabled() and os.path.exists(content_store.path_for(track_id))):
+                wait_for_window() # Links resolved ahead of the window would expire before they are used
+                try:
+                    _, metadata = resolve_track(song.link, track_id)
+                    get_cover(metadata['cover'])
+                except Exception as e:
+                    logging.error(f"Could not prefetch {trackname} --> {e}")
+            resolved.put(trackname)
+
+    threading.Thread(target=resolve, daemon=True).start()
+    try:
+        for _ in tracknames:
+            yield resolved.get()
+    finally:
+        stop.set()
+        while not resolved.empty(): # Unblock the resolver if it is waiting for room
+            resolved.get_nowait()
+
+def buffered_playlist_track(*args):
+    return buffered_call(download_playlist_track, *args)
+
+def download_playlist_track(index, total, trackname, song, outpath, playlist_name, max_attempts, quality="all", journal=None):
+    echo(f"{index}/{total}: {trackname}")
+    track_id = track_id_from_link(song.link)
+    if skip_existing(trackname, outpath, track_id, journal):
+        return EXISTS
+    if content_store.enabled() and os.path.exists(content_store.path_for(track_id)):
+        echo("\tAlready downloaded for another playlist, linking it!")
+        is_high_quality = link_stored_track(sanitize_name(trackname), track_id, outpath)
+        count("tracks", result="linked")
+        if journal:
+            journal.record(trackname, DONE)
+        return is_high_quality
+    wait_for_window() # Before the link is resolved, it would expire while waiting
+    def resolve():
+        resolved = resolve_track(song.link, track_id)
+        if journal:
+            journal.record(trackname, RESOLVED)
+        return resolved
+
+    with timed("track"):
         for attempt in range(max_attempts):
             try:
                 # raise Exception("Testing")
-                resp = get_track_info(song_list_dict[trackname].link, token)
-                if resp["statusCode"] == 403:
-                    print("\tStatus code 403: Unauthorized access. Please provide a new token.")
-                    logging.error("Token expired. Requested new token")
-                    token = get_token(reset=True) # Resets the cache
-                    resp = get_track_info(song_list_dict[trackname].link, token)  # Retry with new token
-                is_high_quality = save_audio(trackname, resp['link'], outpath)
+                # With cached metadata, the link is only resolved once the audio is needed
+                link = lambda: resolve()[0]
+                metadata = cached_metadata(track_id)
+                if metadata is None:
+                    link, metadata = resolve()
+                is_high_quality = save_audio(trackname, link, outpath, metadata, song.track_number, quality, track_id, journal)
+                if is_high_quality is not DEFERRED: # Deferred tracks may still use the link at the end of the run
+                    forget_link(track_id)
                 if is_high_quality is not None:  # Check if download was successful
-                    cover_url = song_list_dict[trackname].cover
-                    if not cover_url.startswith("http"):
-                        cover_url = resp['metadata']['cover']
-                    # cover_art = requests.get(cover_url).content
-                    attach_track_metadata(trackname, outpath, is_high_quality, resp['metadata'], song_list_dict[trackname].track_number)
-                    break # This break is here because we want to break out of the loop of the track was downloaded successfully
+                    return is_high_quality # Return here because we want to break out of the loop if the track was downloaded successfully
             except Exception as e:
                 logging.error(f"Attempt {attempt+1}/{max_attempts} - {playlist_name}: {trackname} --> {e}")
-                print(f"\t\tAttempt {attempt+1}/{max_attempts} failed with error: ", e)
-            
-    remove_empty_files(outpath)
+                echo(f"\t\tAttempt {attempt+1}/{max_attempts} failed with error: ", e)
+                forget_link(track_id) # The link may be what failed, the next attempt resolves a new one
+                if attempt + 1 < max_attempts:
+                    count("track_retries")
+                    time.sleep(backoff_delay(attempt))
+        count("tracks", result="failed")
+        return None
@@ -0,0 +1,156 @@
+import time
+import logging
+import threading
+import requests
+from concurrent.futures import Future, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
+from requests.adapters import HTTPAdapter
+from config import CUSTOM_HEADER, PURR_HEADER, API_BASE_URL, REQUEST_TIMEOUT, POOL_SIZE, RATE_LIMITS, HTTP_RETRIES
+from config import HEDGE_HOSTS, HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_MAX_RATIO
+from rate_limit import HostLimiter, LatencyWindow, HedgeBudget, RETRY_STATUS, backoff_delay, retry_after
+from metrics import count
+
+# One keep-alive session per upstream host, with its headers pre-bound
+SESSION_HEADERS = {
+    "api": CUSTOM_HEADER,    # api.spotidownloader.com
+    "audio": PURR_HEADER,    # simba.purr.rip
+    "cover": {},             # cover art CDN
+}
+
+def discard(future):
+    # The hedged request that lost: its response (if it ever comes) is not read
+    if future.exception() is None:
+        future.result()[0].close()
+
+class LimitedSession(requests.Session):
+    """Session with a default timeout, whose requests go through the host's limiter
+    and are retried with backoff when the host throttles, fails or drops them.
+    With hedging, a GET that is slower than most is sent again and the first response wins."""
+    def __init__(self, name, timeout, limiter, retries=HTTP_RETRIES, hedge=False):
+        super().__init__()
+        self.name = name
+        self.timeout = timeout
+        self.limiter = limiter
+        self.retries = retries
+        self.latencies = LatencyWindow()
+        self.hedges = HedgeBudget(HEDGE_MAX_RATIO) if hedge else None
+
+    def send_once(self, method, url, kwargs, sent=None):
+        # Returns the response and the time it took once the limiter let the request go
+        with self.limiter.slot():
+            if sent is not None:
+                sent.set()
+            started = time.monotonic()
+            response = requests.Session.request(self, method, url, **kwargs)
+        latency = time.monotonic() - started
+        self.latencies.observe(latency)
+        return response, latency
+
+    def send_in_background(self, method, url, kwargs):
+        # Daemon thread rather than an executor, so a stalled loser cannot hold up the exit
+        future = Future()
+        future.sent = threading.Event()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(self.send_once(method, url, kwargs, future.sent))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                future.sent.set()
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def send_hedged(self, method, url, kwargs):
+        # With stream=True the response is back as soon as its headers are, so for audio this is the time to first byte
+        delay = self.latencies.percentile(HEDGE_PERCENTILE) if self.hedges and method == "GET" else None
+        if delay is None:
+            return self.send_once(method, url, kwargs)
+        self.hedges.earn()
+        first = self.send_in_background(method, url, kwargs)
+        first.sent.wait() # The time spent waiting for the limiter does not count
+        try:
+            return first.result(timeout=max(delay, HEDGE_MIN_DELAY))
+        except FutureTimeout:
+            pass
+        if not self.hedges.spend():
+            return first.result()
+        count("hedges", host=self.name)
+        second = self.send_in_background(method, url, kwargs)
+        pending, error = {first, second}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                for loser in (done | pending) - {future}:
+                    loser.add_done_callback(discard)
+                if future is second:
+                    count("hedges_won", host=self.name)
+                return future.result()
+        raise error
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                response, latency = self.send_hedged(method, url, kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.limiter.congested()
+                if attempt == self.retries:
+                    raise
+                delay = backoff_delay(attempt)
+                count("retries", host=self.name, reason=type(e).__name__)
+                logging.warning(f"{method} {url} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            if response.status_code not in RETRY_STATUS:
+                self.limiter.succeeded(latency)
+                return response
+            pause = retry_after(response)
+            self.limiter.congested(pause)
+            if attempt == self.retries:
+                return response
+            delay = pause if pause is not None else backoff_delay(attempt)
+            count("retries", host=self.name, reason=response.status_code)
+            logging.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            response.close()
+            time.sleep(delay)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_pool_size = POOL_SIZE
+
+def configure(workers=1):
+    # Every worker may hold a connection to each host, so size the pools accordingly
+    global _pool_size
+    _pool_size = max(POOL_SIZE, workers)
+
+def get_session(name):
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is None:
+            rate, burst = RATE_LIMITS[name]
+            session = LimitedSession(name, REQUEST_TIMEOUT, HostLimiter(rate, burst, _pool_size), hedge=name in HEDGE_HOSTS)
+            session.headers.update(SESSION_HEADERS[name])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[name] = session
+        return session
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+def api_get(path, **kwargs):
+    return get_session("api").get(f"{API_BASE_URL}/{path}", **kwargs)
+
+def audio_get(url, **kwargs):
+    return get_session("audio").get(url, **kwargs)
+
+def cover_get(url, **kwargs):
+    return get_session("cover").get(url, **kwargs)
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import threading
+from config import JOURNAL_BATCH, JOURNAL_FLUSH_INTERVAL
+from models import Song
+
+# Track states, in the order a track goes through them. A skipped track is finished as well.
+RESOLVED = "resolved"
+DOWNLOADED = "downloaded"
+TAGGED = "tagged"
+DONE = "done"
+SKIPPED = "skipped"
+FINISHED = (DONE, SKIPPED)
+
+def journal_path(outpath, mode, playlist_id):
+    return os.path.join(outpath, f".spdl-journal-{mode}-{playlist_id}.jsonl")
+
+class Journal:
+    """Append-only record of a playlist run: the run itself, its tracks (as the listing arrives)
+    and every state each track reaches. Records are fsynced in batches, so a crash loses at most
+    the last batch, and the run can be picked up from the journal instead of from the API.
+    The journal is removed once the run completes."""
+    def __init__(self, path):
+        self.path = path
+        self.run = None
+        self.songs = {}
+        self.listed = False
+        self.states = {}
+        self.file = None
+        self.pending = []
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.replay()
+
+    def replay(self):
+        good = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break # Torn write at the time of the crash, nothing after it was synced
+                good += len(line)
+                if "run" in record:
+                    self.run = record["run"]
+                elif "tracks" in record:
+                    self.songs.update((name, Song(*fields)) for name, fields in record["tracks"].items())
+                elif "listed" in record:
+                    self.listed = True
+                else:
+                    self.merge(record)
+        if os.path.getsize(self.path) > good:
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+
+    def resumable(self):
+        return self.run is not None
+
+    def start(self, run):
+        # A new run replaces whatever an earlier, unfinished one left behind
+        with self.lock:
+            self.run = run
+            self.songs, self.listed, self.states = {}, False, {}
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.path, "w")
+            self.pending = [json.dumps({"run": run})]
+            self.sync()
+
+    def add_tracks(self, song_list_dict):
+        self.songs.update(song_list_dict)
+        fields = {
+            name: list(song)
+            for name, song in song_list_dict.items()
+        }
+        self.append({"tracks": fields})
+
+    def mark_listed(self):
+        self.listed = True
+        self.append({"listed": True})
+
+    def record(self, trackname, state, **data):
+        record = {"track": trackname, "state": state, **data}
+        self.merge(record)
+        self.append(record)
+
+    def merge(self, record):
+        # A state only records what changed, the details of earlier states carry over
+        _, data = self.state_of(record["track"])
+        self.states[record["track"]] = (record["state"], {**data, **record})
+
+    def state_of(self, trackname):
+        return self.states.get(trackname, (None, {}))
+
+    def append(self, record):
+        with self.lock:
+            self.pending.append(json.dumps(record))
+            if len(self.pending) >= JOURNAL_BATCH or time.monotonic() - self.last_sync >= JOURNAL_FLUSH_INTERVAL:
+                self.sync()
+
+    def sync(self):
+        if self.file is None:
+            self.file = open(self.path, "a")
+        if self.pending:
+            self.file.write("\n".join(self.pending) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = []
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        # Keeps the journal for the next run to pick up
+        with self.lock:
+            if self.file is not None or self.pending:
+                self.sync()
+                self.file.close()
+                self.file = None
+
+    def finish(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.pending = []
+            if os.path.exists(self.path):
+                os.remove(self.path)
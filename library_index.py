@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import threading
+import logging
+from mutagen.mp3 import MP3
+from tagging import read_track_id
+
+# Every download folder keeps an index of the tracks it contains (including low_quality/),
+# keyed by Spotify track ID and by file name, so existence checks do not depend on the
+# naming convention and do not need to list the folder.
+INDEX_FILE = ".spdl-library.sqlite"
+LOW_QUALITY_FOLDER = "low_quality"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    track_id TEXT,
+    name TEXT NOT NULL,
+    bitrate REAL,
+    size INTEGER,
+    tagged INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tracks_track_id ON tracks (track_id);
+CREATE INDEX IF NOT EXISTS tracks_name ON tracks (name);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+def track_name(path):
+    return os.path.basename(path)[:-len(".mp3")]
+
+def read_track_file(folder, path):
+    # Index row for an existing file, built from its ID3 tags and stream info
+    filepath = os.path.join(folder, path)
+    track_id, bitrate, tagged = None, None, False
+    try:
+        audio = MP3(filepath)
+        track_id = read_track_id(audio.tags)
+        tagged = audio.tags is not None and bool(audio.tags.getall("APIC"))
+        bitrate = audio.info.bitrate / 1000
+    except Exception as e:
+        logging.error(f"Could not read {filepath} while indexing --> {e}")
+    return (path, track_id, track_name(path), bitrate, os.path.getsize(filepath), int(tagged))
+
+class LibraryIndex:
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(folder, INDEX_FILE), check_same_thread=False)
+        # The index lives in the folder it indexes: with the default journal mode SQLite creates and
+        # deletes its journal file there on every commit, which changes the folder's mtime each time
+        self.conn.execute("PRAGMA journal_mode=PERSIST")
+        self.conn.executescript(SCHEMA)
+        self.refresh()
+
+    def folder_state(self):
+        # Directory mtimes change whenever files are added, renamed or removed
+        states = []
+        for folder in (self.folder, os.path.join(self.folder, LOW_QUALITY_FOLDER)):
+            states.append(str(os.stat(folder).st_mtime_ns) if os.path.isdir(folder) else "-")
+        return ",".join(states)
+
+    def list_files(self):
+        files = []
+        for subfolder in ("", LOW_QUALITY_FOLDER):
+            folder = os.path.join(self.folder, subfolder)
+            if not os.path.isdir(folder):
+                continue
+            for file in os.listdir(folder):
+                if file.endswith(".mp3") and not file.startswith("temp_"):
+                    files.append(os.path.join(subfolder, file) if subfolder else file)
+        return files
+
+    def refresh(self, force=False):
+        """Brings the index up to date with files added or removed outside of spdl.
+        This is a no-op (no directory listing) when the folder did not change since the last update."""
+        state = self.folder_state()
+        with self.lock:
+            stored = self.conn.execute("SELECT value FROM meta WHERE key = 'folder_state'").fetchone()
+            if not force and stored and stored[0] == state:
+                return
+            indexed = {row[0] for row in self.conn.execute("SELECT path FROM tracks")}
+        on_disk = set(self.list_files())
+        rows = [read_track_file(self.folder, path) for path in on_disk - indexed]
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM tracks WHERE path = ?", [(path,) for path in indexed - on_disk])
+            self.conn.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('folder_state', ?)", (state,))
+
+    def rebuild(self):
+        # Re-reads the tags of every file in the folder
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM tracks")
+        self.refresh(force=True)
+        return self.count()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def find(self, track_id=None, name=None):
+        # Path of the track with this ID or file name, None if it is not in the folder
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path FROM tracks WHERE track_id = ? OR name = ? LIMIT 1", (track_id, name)
+            ).fetchone()
+        if row is None:
+            return None
+        path = os.path.join(self.folder, row[0])
+        if not os.path.exists(path):
+            with self.lock, self.conn:
+                self.conn.execute("DELETE FROM tracks WHERE path = ?", (row[0],))
+            return None
+        return path
+
+    def contents(self):
+        # (track IDs, file names) of every indexed track, for bulk lookups
+        with self.lock:
+            rows = self.conn.execute("SELECT track_id, name FROM tracks").fetchall()
+        return {row[0] for row in rows if row[0]}, {row[1] for row in rows}
+
+    def tracks(self):
+        # (file path, track ID) of every indexed track
+        with self.lock:
+            rows = self.conn.execute("SELECT path, track_id FROM tracks ORDER BY path").fetchall()
+        return [(os.path.join(self.folder, path), track_id) for path, track_id in rows]
+
+    def size_stats(self):
+        # (number of tracks, total bytes), for estimating the size of tracks not downloaded yet
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(size), COALESCE(SUM(size), 0) FROM tracks WHERE size > 0").fetchone()
+
+    def record(self, filepath, track_id, bitrate, tagged=True):
+        path = os.path.relpath(filepath, self.folder)
+        row = (path, track_id, track_name(path), bitrate, os.path.getsize(filepath), int(tagged))
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)", row)
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('folder_state', ?)", (self.folder_state(),))
+
+_libraries = {}
+_libraries_lock = threading.Lock()
+
+def library_for(folder):
+    folder = os.path.abspath(folder)
+    with _libraries_lock:
+        library = _libraries.get(folder)
+        if library is None:
+            library = _libraries[folder] = LibraryIndex(folder)
+        return library
+
+def library_folders(root):
+    # Every download folder under root, i.e. every folder that contains tracks (low_quality/ belongs to its parent)
+    for dirpath, dirnames, filenames in os.walk(root):
+        if os.path.basename(dirpath) == LOW_QUALITY_FOLDER:
+            continue
+        if any(file.endswith(".mp3") for file in filenames) or LOW_QUALITY_FOLDER in dirnames:
+            yield dirpath
+
+def reindex(root):
+    # Rebuilds the index of every folder under root that contains tracks
+    for dirpath in library_folders(root):
+        count = library_for(dirpath).rebuild()
+        print(f"Indexed {count} track(s) in {dirpath}")
+        logging.info(f"Indexed {count} track(s) in {dirpath}")
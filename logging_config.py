@@ -1,19 +1,51 @@
-import sys
+import copy
+import json
+import queue
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
-def setup_logging():
-    if sys.version_info >= (3, 9):
-        logging.basicConfig(
-            filename="spdl.log",
-            filemode="a",
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            encoding="utf-8"
-        )
+LOG_FORMATS = ("json", "text")
+
+class JsonLinesFormatter(logging.Formatter):
+    # One JSON object per line, so the log can be filtered and aggregated by field
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "module": record.module,
+            "function": record.funcName,
+            "thread": record.threadName,
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class RecordQueueHandler(QueueHandler):
+    # Hands the record over with its message resolved and the traceback as text (both can hold
+    # objects that are not safe to use from another thread), but unformatted otherwise
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging(log_format="json", filename="spdl.log"):
+    # Workers only put records on a queue, a background thread does the formatting and file writes
+    file_handler = logging.FileHandler(filename, mode="a", encoding="utf-8")
+    if log_format == "json":
+        file_handler.setFormatter(JsonLinesFormatter())
     else:
-        file_handler = logging.FileHandler("spdl.log", mode="a", encoding="utf-8")
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        file_handler.setFormatter(formatter)
-        logger = logging.getLogger()
-        logger.setLevel(logging.INFO)
-        logger.addHandler(file_handler)
\ No newline at end of file
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    records = queue.SimpleQueue() if hasattr(queue, "SimpleQueue") else queue.Queue()
+    listener = QueueListener(records, file_handler, respect_handler_level=True)
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(RecordQueueHandler(records))
+    listener.start()
+    atexit.register(listener.stop) # Writes out what is still queued
+    return listener
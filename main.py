@@ -2,10 +2,23 @@ import argparse
 import os
 import logging
 import sys
-from utils import get_token, trackname_convention
-from downloader import check_track_playlist
-from sync import handle_sync_file
-from logging_config import setup_logging
+from utils import get_token, trackname_convention, set_output_mode
+from downloader import check_track_playlist, retag_library
+from sync import handle_sync_file, read_sync_file
+from daemon import run_daemon
+from plan import write_plan, execute_plan
+from library_index import reindex
+from logging_config import setup_logging, LOG_FORMATS
+from config import QUALITY_POLICIES, DOWNLOAD_ORDERS, TRACK_METADATA_TTL, TAG_PADDING, DAEMON_INTERVAL, DAEMON_PORT
+import http_client
+import cover_cache
+import snapshots
+import track_cache
+import tagging
+import scheduler
+import content_store
+import token_manager
+import metrics
 
 
 
@@ -16,26 +29,87 @@ def main():
     parser.add_argument("-link", nargs="+", help="URL of the Spotify track or playlist")
     parser.add_argument("-outpath", nargs="?", default=os.getcwd(), help="Path to save the downloaded track")
     parser.add_argument("-sync", nargs="?", const="sync.json", help="Path of sync.json file to sync local playlist folders with Spotify playlists")
+    parser.add_argument("-plan", nargs="?", const="spdl-plan.json", default=None, help="Only work out what -link or -sync would download and save it to this JSON plan")
+    parser.add_argument("-execute", default=None, help="Download the tracks of a plan saved by -plan, without listing the playlists again")
+    parser.add_argument("-daemon", action="store_true", help="Keep running and sync every entry of the sync file on its own schedule")
+    parser.add_argument("-interval", type=float, default=DAEMON_INTERVAL / 60, help="Minutes between two syncs of an entry in daemon mode (entries can set their own \"interval\")")
+    parser.add_argument("-controlport", type=int, default=DAEMON_PORT, help="Port of the daemon's status/trigger endpoint on localhost")
     parser.add_argument("-folder", nargs="?", default=True, help="Create a folder for the playlist(s)")
+    parser.add_argument("-reindex", nargs="?", const=os.getcwd(), help="Rebuild the track index of every download folder under this path from the files' tags")
+    parser.add_argument("-retag", nargs="?", const=os.getcwd(), help="Rewrite the tags (title, artists, album, release date, cover) of every downloaded track under this path")
+    parser.add_argument("-tagpadding", type=int, default=TAG_PADDING // 1024, help="KiB of free space reserved in the tags of downloaded tracks, so they can be retagged in place")
+    parser.add_argument("-cachedir", nargs="?", default=None, help="Directory for caches that persist across runs (cover art, playlist snapshots, track metadata). Defaults to .spdl-cache next to sync.json when syncing")
+    parser.add_argument("-metadatattl", type=float, default=TRACK_METADATA_TTL / 86400, help="Days the track metadata kept in the cache directory is used before it is fetched again (0: always fetch)")
+    parser.add_argument("-quality", choices=QUALITY_POLICIES, default="all", help="all: keep low quality tracks in low_quality/, high: skip them, defer: download them last")
+    parser.add_argument("-bandwidth", type=int, default=0, help="Cap on the total download rate of all the tracks downloading at once, in KiB/s (0: no cap)")
+    parser.add_argument("-offpeak", default=None, help="Only download tracks during this time window, e.g. 22:00-06:00 (listings and metadata are fetched at any time)")
+    parser.add_argument("-order", choices=DOWNLOAD_ORDERS, default="album", help="album: download the new tracks grouped by album, smaller albums first, playlist: in the order of the playlist")
+    parser.add_argument("-store", nargs="?", default=None, help="Download every track once into this directory and hard link it into each playlist folder")
+    parser.add_argument("-tokensource", default="prompt", help="Where to get a new token from: prompt, env:NAME, file:PATH or cmd:COMMAND (for unattended runs)")
+    parser.add_argument("-metrics", nargs="?", const="spdl-metrics.json", default=None, help="Write a JSON summary of the time spent per stage and the run's counters to this file")
+    parser.add_argument("-prometheus", nargs="?", const="spdl.prom", default=None, help="Keep the same metrics in this Prometheus text file (e.g. in the node exporter's textfile directory), updated during the run")
+    parser.add_argument("-logformat", choices=LOG_FORMATS, default="json", help="Format of spdl.log: one JSON object per line, or plain text")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("-quiet", action="store_true", help="Only print failed tracks and summaries")
+    output.add_argument("-verbose", action="store_true", help="List every track of the playlists and print the progress of each track")
+    parser.add_argument("-workers", type=int, default=1, help="Number of tracks to download in parallel")
 
     args = parser.parse_args()
+    setup_logging(args.logformat)
+    logging.info("-" * 10 + "Program started" + "-" * 10)
+    set_output_mode("quiet" if args.quiet else "verbose" if args.verbose else "progress")
+    http_client.configure(workers=args.workers)
+    token_manager.configure(args.tokensource)
+    metrics.configure(args.metrics, args.prometheus)
+    if args.daemon and not args.sync:
+        args.sync = "sync.json"
+    cache_dir = args.cachedir
+    if cache_dir is None and args.sync:
+        # Syncs always keep their playlist snapshots next to sync.json
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(args.sync)), ".spdl-cache")
+    cover_cache.configure(cache_dir=cache_dir)
+    snapshots.configure(cache_dir=cache_dir)
+    track_cache.configure(cache_dir=cache_dir, ttl=args.metadatattl * 86400)
+    content_store.configure(args.store)
+    tagging.configure(padding=args.tagpadding * 1024)
+    try:
+        scheduler.configure(rate=args.bandwidth * 1024 or None, window=args.offpeak, order=args.order)
+    except ValueError as e:
+        parser.error(str(e))
 
-    if args.sync:
-        handle_sync_file(os.path.abspath(args.sync))
+    if args.reindex:
+        reindex(os.path.abspath(args.reindex))
+    elif args.retag:
+        retag_library(os.path.abspath(args.retag))
+    elif args.execute:
+        execute_plan(args.execute, workers=args.workers)
+    elif args.plan and args.sync:
+        targets = [(data['link'], data['download_location'], data['create_folder'], convention) for data, convention in read_sync_file(args.sync)]
+        write_plan(targets, args.plan, quality=args.quality)
+    elif args.plan:
+        _, set_trackname_convention = trackname_convention()
+        write_plan([(link, args.outpath, args.folder, set_trackname_convention) for link in args.link], args.plan, quality=args.quality)
+    elif args.daemon:
+        if not os.path.exists(args.sync):
+            print(f"Sync file {args.sync} does not exist. Create it with -sync first")
+            return
+        run_daemon(os.path.abspath(args.sync), workers=args.workers, quality=args.quality, interval=args.interval * 60, port=args.controlport)
+    elif args.sync:
+        handle_sync_file(os.path.abspath(args.sync), workers=args.workers, quality=args.quality)
     else:
         token = get_token()
         _, set_trackname_convention = trackname_convention()
         for link in args.link:
-            check_track_playlist(link, args.outpath, create_folder=args.folder, trackname_convention=set_trackname_convention, token=token)
+            check_track_playlist(link, args.outpath, create_folder=args.folder, trackname_convention=set_trackname_convention, token=token, workers=args.workers, quality=args.quality)
     
     print("\n" + "-"*25 + " Task complete ;) " + "-"*25 + "\n")
 
 if __name__ == "__main__":
     try:
-        setup_logging()
-        logging.info("-" * 10 + "Program started" + "-" * 10)
         main()
         logging.info("-" * 10 + "Program ended" + "-" * 10)
     except KeyboardInterrupt:
         print("\n------ Exiting program ------")
         logging.info("Program exited by user")
+    finally:
+        metrics.export()
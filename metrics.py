@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from config import METRICS_INTERVAL
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+COUNTER_HELP = {
+    "bytes": "Bytes received, by kind",
+    "retries": "Requests retried after a throttled, failed or dropped attempt, by host and reason",
+    "hedges": "Slow requests sent a second time, by host",
+    "hedges_won": "Hedged requests where the second request answered first, by host",
+    "track_retries": "Track downloads attempted again after an error",
+    "token_refreshes": "Tokens requested from the token source, by reason",
+    "tracks": "Tracks handled, by result (downloaded, linked, exists, low_quality, deferred, failed)",
+    "cover_cache": "Cover art lookups, by where the cover came from",
+    "metadata_cache": "Track metadata lookups, by result (hit or miss)",
+    "daemon_syncs": "Entries synced by the daemon, by result",
+    "retagged": "Tracks retagged, by whether the new tag fitted in place or the file was rewritten",
+}
+
+class Metrics:
+    """Durations per stage and counters of one run, thread-safe"""
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(DURATION_BUCKETS)}
+            entry["count"] += 1
+            entry["sum"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    entry["buckets"][i] += 1
+                    break
+
+    @contextmanager
+    def timed(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def summary(self):
+        with self.lock:
+            stages = {
+                stage: {
+                    "count": entry["count"],
+                    "total_seconds": round(entry["sum"], 4),
+                    "mean_seconds": round(entry["sum"] / entry["count"], 4),
+                    "max_seconds": round(entry["max"], 4),
+                }
+                for stage, entry in sorted(self.stages.items())
+            }
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                label = ",".join(f"{key}={value}" for key, value in labels)
+                counters.setdefault(name, {})[label or "total"] = value
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration_seconds": round(time.time() - self.started, 3),
+            "command": sys.argv[1:],
+            "stages": stages,
+            "counters": counters,
+        }
+
+    def prometheus(self):
+        lines = [
+            "# HELP spdl_run_start_time_seconds Start time of the run",
+            "# TYPE spdl_run_start_time_seconds gauge",
+            f"spdl_run_start_time_seconds {self.started:.3f}",
+            "# HELP spdl_stage_duration_seconds Time spent per stage",
+            "# TYPE spdl_stage_duration_seconds histogram",
+        ]
+        with self.lock:
+            for stage, entry in sorted(self.stages.items()):
+                label = f'stage="{escape(stage)}"'
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS, entry["buckets"]):
+                    cumulative += count
+                    lines.append(f'spdl_stage_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'spdl_stage_duration_seconds_bucket{{{label},le="+Inf"}} {entry["count"]}')
+                lines.append(f"spdl_stage_duration_seconds_sum{{{label}}} {entry['sum']:.6f}")
+                lines.append(f"spdl_stage_duration_seconds_count{{{label}}} {entry['count']}")
+            described = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = f"spdl_{name}_total"
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {metric} {COUNTER_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {metric} counter")
+                label = ",".join(f'{key}="{escape(value)}"' for key, value in labels)
+                lines.append(f"{metric}{{{label}}} {value}" if label else f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+_summary_path = None
+_prometheus_path = None
+
+def timed(stage):
+    return metrics.timed(stage)
+
+def count(name, amount=1, **labels):
+    metrics.count(name, amount, **labels)
+
+def configure(summary_path=None, prometheus_path=None, interval=METRICS_INTERVAL):
+    # The Prometheus file is also rewritten every interval seconds, so long syncs can be watched
+    global _summary_path, _prometheus_path
+    _summary_path = os.path.abspath(summary_path) if summary_path else None
+    _prometheus_path = os.path.abspath(prometheus_path) if prometheus_path else None
+    if _prometheus_path:
+        threading.Thread(target=export_periodically, args=(interval,), daemon=True).start()
+
+def export_periodically(interval):
+    while True:
+        time.sleep(interval)
+        export(summary=False)
+
+def export(summary=True):
+    from utils import write_atomic # utils depends on modules that record metrics
+    if _prometheus_path:
+        write_atomic(_prometheus_path, metrics.prometheus().encode())
+    if summary and _summary_path:
+        write_atomic(_summary_path, json.dumps(metrics.summary(), indent=2).encode())
@@ -1,7 +1,8 @@
 from dataclasses import dataclass
+from typing import NamedTuple
 
-@dataclass(init=True, eq=True, frozen=True)
-class Song:
+# A tuple rather than a dataclass: no per-instance __dict__, which adds up for playlists with 100k+ tracks
+class Song(NamedTuple):
     title: str
     artists: str
     album: str
@@ -16,4 +17,15 @@ class Song:
     
     # def __hash__(self):
     #     print("Hello 2")
-    #     return hash((self.title, self.artists, self.album))
\ No newline at end of file
+    #     return hash((self.title, self.artists, self.album))
+
+@dataclass(eq=False)
+class PlaylistJob:
+    name: str
+    outpath: str
+    song_list_dict: dict
+    pending: int = 0
+    downloaded: int = 0
+    skipped: int = 0
+    failed: int = 0
+    journal: object = None
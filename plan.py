@@ -0,0 +1,185 @@
+"""Plans a run without downloading anything, and runs a plan later.
+
+A plan lists, for every playlist/album, the tracks that would be downloaded and counts the ones that
+would be skipped (already in the folder), deduplicated (the same track twice in the listing) or linked
+from the track store, with an estimate of the bytes to download. Listings come from the playlist
+snapshots when the playlist did not change, and existing tracks from the folder indexes, so planning
+takes one metadata request per playlist. Running the plan goes straight to the downloads.
+"""
+import os
+import re
+import json
+import time
+from collections import Counter
+from config import PLAN_TRACK_BYTES, HIGH_QUALITY_BITRATE
+from models import Song
+from library_index import library_for
+from spotify_api import get_playlist_metadata, iter_playlist_tracks
+from track_cache import cached_metadata
+from downloader import resolve_track, download_planned_tracks, check_track_playlist, track_outcome, EXISTS
+from token_manager import tokens
+from utils import make_unique_song_objects, sanitize_name, track_id_from_link, write_atomic, echo
+import content_store
+
+PLAN_VERSION = 1
+
+def link_mode(link):
+    if re.search(r".*spotify\.com\/(?:intl-[a-zA-Z]{2}\/)?track\/", link):
+        return 'track'
+    return 'album' if re.search(r".*spotify\.com\/album\/", link) else 'playlist'
+
+def folder_contents(folder):
+    # (track IDs, file names) of the tracks already in folder, without creating anything if it does not exist yet
+    if not os.path.isdir(folder):
+        return set(), set()
+    library = library_for(folder)
+    library.refresh()
+    return library.contents()
+
+def plan_playlist(link, outpath, create_folder, trackname_convention, mode, token):
+    metadata = get_playlist_metadata(link, mode, token)
+    playlist_name = sanitize_name(metadata['title'])
+    folder = os.path.join(outpath, playlist_name) if create_folder == True else outpath
+    known_ids, known_names = folder_contents(folder)
+    seen_names, seen_ids = set(), set()
+    song_list_dict = {}
+    listed = existing = 0
+    for page in iter_playlist_tracks(link, mode, metadata):
+        existing += sum(1 for track in page if track['id'] in known_ids)
+        songs = make_unique_song_objects(page, trackname_convention, metadata['title'], mode, known_ids, listed + 1, seen_names, seen_ids)
+        listed += len(page)
+        song_list_dict.update(songs)
+    new = {trackname: song for trackname, song in song_list_dict.items() if trackname not in known_names}
+    existing += len(song_list_dict) - len(new)
+    return {
+        "link": link,
+        "mode": mode,
+        "trackname_convention": trackname_convention,
+        "name": playlist_name,
+        "outpath": folder,
+        "listed": listed,
+        "existing": existing,
+        "duplicates": listed - existing - len(new),
+        "tracks": {trackname: list(song) for trackname, song in new.items()},
+    }
+
+def plan_track(link, outpath, trackname_convention):
+    track_id = track_id_from_link(link)
+    metadata = cached_metadata(track_id)
+    if metadata is None:
+        _, metadata = resolve_track(link, track_id)
+    songs = make_unique_song_objects([{"id": track_id, **metadata}], trackname_convention, None, 'track')
+    known_ids, known_names = folder_contents(outpath)
+    exists = track_id in known_ids or any(trackname in known_names for trackname in songs)
+    return {
+        "link": link,
+        "mode": 'track',
+        "trackname_convention": trackname_convention,
+        "name": next(iter(songs)),
+        "outpath": outpath,
+        "listed": 1,
+        "existing": int(exists),
+        "duplicates": 0,
+        "tracks": {} if exists else {trackname: list(song) for trackname, song in songs.items()},
+    }
+
+def estimate(entries):
+    # Average size of the tracks already downloaded to the planned folders, or PLAN_TRACK_BYTES
+    tracks = total = 0
+    for folder in {entry["outpath"] for entry in entries}:
+        if os.path.isdir(folder):
+            count, size = library_for(folder).size_stats()
+            tracks, total = tracks + count, total + size
+    return total // tracks if tracks else PLAN_TRACK_BYTES
+
+def make_plan(targets, quality="all"):
+    """targets are (link, download location, create folder, trackname convention) tuples.
+    Returns the plan, with the totals of what it would download and skip."""
+    entries = []
+    for link, outpath, create_folder, trackname_convention in targets:
+        mode = link_mode(link)
+        echo(f"Planning {link}")
+        if mode == 'track':
+            entries.append(plan_track(link, outpath, trackname_convention))
+        else:
+            entries.append(plan_playlist(link, outpath, create_folder, trackname_convention, mode, tokens.get()))
+
+    track_bytes = estimate(entries)
+    planned_ids = set()
+    for entry in entries:
+        # Tracks in the store, or planned for an earlier playlist, are linked instead of downloaded again
+        linked = low_quality = 0
+        for fields in entry["tracks"].values():
+            track_id = track_id_from_link(Song(*fields).link)
+            if content_store.enabled() and (track_id in planned_ids or os.path.exists(content_store.path_for(track_id))):
+                linked += 1
+                bitrate = content_store.bitrate_of(track_id) if track_id not in planned_ids else None
+                low_quality += bitrate is not None and bitrate < HIGH_QUALITY_BITRATE
+            planned_ids.add(track_id)
+        entry["download"] = len(entry["tracks"]) - linked
+        entry["linked"] = linked
+        entry["low_quality_linked"] = low_quality
+        entry["estimated_bytes"] = entry["download"] * track_bytes
+
+    totals = {
+        key: sum(entry[key] for entry in entries)
+        for key in ("listed", "existing", "duplicates", "download", "linked", "low_quality_linked", "estimated_bytes")
+    }
+    return {
+        "version": PLAN_VERSION,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "quality": quality,
+        "track_bytes": track_bytes,
+        "totals": totals,
+        "entries": entries,
+    }
+
+def print_plan(plan):
+    for entry in plan["entries"]:
+        echo(
+            f"{entry['name']} ({entry['outpath']}): {entry['download']} to download, {entry['linked']} to link, "
+            f"{entry['existing']} already there, {entry['duplicates']} duplicate(s), ~{entry['estimated_bytes'] / 2**20:.0f} MB"
+        )
+    totals = plan["totals"]
+    print("-" * 40)
+    print(
+        f"Plan: {totals['download']} track(s) to download (~{totals['estimated_bytes'] / 2**20:.0f} MB), {totals['linked']} to link "
+        f"from the store, {totals['existing']} already downloaded, {totals['duplicates']} duplicate(s) in the listings"
+    )
+    if totals["low_quality_linked"]:
+        print(f"{totals['low_quality_linked']} of the tracks to link are below {HIGH_QUALITY_BITRATE}kbps")
+    if plan["quality"] != "all":
+        print(f"Tracks below {HIGH_QUALITY_BITRATE}kbps are only found while downloading, -quality {plan['quality']} applies then")
+
+def write_plan(targets, plan_file, quality="all"):
+    plan = make_plan(targets, quality)
+    write_atomic(os.path.abspath(plan_file), json.dumps(plan, indent=2).encode("utf-8"))
+    print_plan(plan)
+    print(f"Saved the plan to {plan_file}, run it with -execute \"{plan_file}\"")
+    return plan
+
+def execute_plan(plan_file, workers=1):
+    with open(plan_file, encoding="utf-8") as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        print(f"{plan_file} was written by another version of spdl, plan the run again")
+        return
+    quality = plan["quality"]
+    print(f"Running the plan of {plan['created']}: {plan['totals']['download'] + plan['totals']['linked']} track(s)")
+    outcomes = Counter()
+    for entry in plan["entries"]:
+        if not entry["tracks"]:
+            continue
+        if entry["mode"] == 'track':
+            result = check_track_playlist(entry["link"], entry["outpath"], False, entry["trackname_convention"], tokens.get(), quality=quality)
+            outcomes[EXISTS if result == EXISTS else track_outcome(result)] += 1
+            continue
+        song_list_dict = {trackname: Song(*fields) for trackname, fields in entry["tracks"].items()}
+        outcomes += download_planned_tracks(entry["link"], entry["outpath"], entry["name"], song_list_dict, entry["mode"], workers=workers, quality=quality)
+    print("-" * 40)
+    # Tracks that turned up in their folder since the plan was made are neither downloaded nor linked
+    # from the store again: the folder is checked before anything else
+    print(
+        f"Plan done: {outcomes['downloaded']} downloaded, {outcomes[EXISTS]} already there since the plan was made, "
+        f"{outcomes['skipped']} skipped, {outcomes['failed']} failed"
+    )
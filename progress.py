@@ -0,0 +1,75 @@
+import sys
+import time
+from config import PROGRESS_INTERVAL, PROGRESS_LOG_INTERVAL
+from utils import output_mode
+
+OUTCOMES = ("downloaded", "skipped", "deferred", "failed")
+
+class ProgressRenderer:
+    """A single status line for a batch of tracks instead of their full output.
+    On a terminal the line is redrawn at most every PROGRESS_INTERVAL seconds; when the output
+    is redirected a new line is written every PROGRESS_LOG_INTERVAL seconds. The output of failed
+    tracks is always shown, the output of every track only in verbose mode."""
+    def __init__(self, label, total=0, stream=None):
+        self.label = label
+        self.total = total
+        self.stream = stream or sys.stdout
+        self.tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self.interval = PROGRESS_INTERVAL if self.tty else PROGRESS_LOG_INTERVAL
+        self.counts = dict.fromkeys(OUTCOMES, 0)
+        self.started = time.monotonic()
+        self.last_render = self.started
+        self.width = 0
+
+    def add(self, count):
+        self.total += count
+
+    def report(self, lines, outcome):
+        # Takes the output and the outcome of one track. Deferred tracks are reported again later.
+        self.counts[outcome] += 1
+        if output_mode() == "verbose" or outcome == "failed":
+            self.clear()
+            for line in lines:
+                print(line, file=self.stream)
+        self.render()
+
+    def message(self, text, always=False):
+        if always or output_mode() != "quiet":
+            self.clear()
+            print(text, file=self.stream)
+            if self.tty: # Back below the message
+                self.render(force=True)
+
+    def status(self):
+        done = self.counts["downloaded"] + self.counts["skipped"] + self.counts["failed"]
+        elapsed = time.monotonic() - self.started
+        rate = self.counts["downloaded"] / elapsed if elapsed else 0
+        return (
+            f"{self.label}: {done}/{self.total} track(s) | {self.counts['downloaded']} downloaded, "
+            f"{self.counts['skipped']} skipped, {self.counts['failed']} failed | {rate:.1f} tracks/s"
+        )
+
+    def render(self, force=False):
+        if output_mode() != "progress":
+            return
+        now = time.monotonic()
+        if not force and now - self.last_render < self.interval:
+            return
+        self.last_render = now
+        text = self.status()
+        if self.tty:
+            self.stream.write("\r" + text.ljust(self.width))
+            self.width = len(text)
+        else:
+            self.stream.write(text + "\n")
+        self.stream.flush()
+
+    def clear(self):
+        if self.tty and self.width:
+            self.stream.write("\r" + " " * self.width + "\r")
+            self.width = 0
+
+    def close(self):
+        # Leaves the final counts on screen, in every mode
+        self.clear()
+        print(self.status(), file=self.stream)
@@ -0,0 +1,172 @@
+import time
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from config import BACKOFF_BASE, BACKOFF_MAX, HEDGE_WINDOW
+
+# Responses that mean the host is throttling us or struggling
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# A request this many times slower than the running average counts as congestion
+LATENCY_SPIKE_FACTOR = 3
+LATENCY_MIN_SAMPLES = 10
+# The concurrency limit is halved at most once per cooldown, a burst of errors is one signal
+DECREASE_COOLDOWN = 1.0
+# Latency percentiles are only trusted after this many requests
+PERCENTILE_MIN_SAMPLES = 20
+# Unused hedges that can be saved up for a burst of slow requests
+HEDGE_BURST = 5
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def retry_after(response):
+    """Seconds to wait according to the Retry-After header (delay or HTTP date), None if absent"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class ByteBucket:
+    """Shared cap of `rate` bytes per second, with bursts of up to `burst` bytes.
+    Callers take what they need at once and then sleep off the debt, so concurrent
+    transfers are served in the order they asked and share the rate evenly."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - size
+            self.updated = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+class HostLimiter:
+    """Rate and concurrency limit for one upstream host.
+    Requests go through a token bucket, and at most `limit` of them are in flight at once.
+    The limit follows AIMD: it grows by about one per round of successful requests,
+    and is halved on 429/5xx, dropped connections or latency spikes."""
+    def __init__(self, rate, burst, max_limit):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.active = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.latency = None
+        self.samples = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.cond:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                elif self.active >= int(self.limit):
+                    self.cond.wait()
+                else:
+                    break
+            self.active += 1
+        try:
+            self.bucket.acquire()
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    def succeeded(self, latency):
+        with self.cond:
+            if self.samples >= LATENCY_MIN_SAMPLES and latency > LATENCY_SPIKE_FACTOR * self.latency:
+                self._decrease()
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.samples += 1
+            self.cond.notify_all()
+
+    def congested(self, pause=None):
+        with self.cond:
+            self._decrease()
+            if pause:
+                # Retry-After applies to the whole host, not just the request that got it
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= DECREASE_COOLDOWN:
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+
+class LatencyWindow:
+    """Latencies of the last `size` requests to a host"""
+    def __init__(self, size=HEDGE_WINDOW):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def observe(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+
+    def percentile(self, fraction):
+        # None until there are enough samples to tell
+        with self.lock:
+            if len(self.samples) < PERCENTILE_MIN_SAMPLES:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+class HedgeBudget:
+    """Allows one hedged request per 1/ratio requests sent, saving up at most `burst` of them"""
+    def __init__(self, ratio, burst=HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.credit = 0.0
+        self.lock = threading.Lock()
+
+    def earn(self):
+        with self.lock:
+            self.credit = min(self.burst, self.credit + self.ratio)
+
+    def spend(self):
+        with self.lock:
+            if self.credit < 1:
+                return False
+            self.credit -= 1
+            return True
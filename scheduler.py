@@ -0,0 +1,101 @@
+"""Decides when and in what order audio is downloaded.
+
+- A cap on the total download rate, shared by every transfer of the run (bytes are only read from
+  the socket as fast as the cap allows, so TCP slows the sender down).
+- An off-peak window: downloads only start during the configured hours. Listings, metadata, covers
+  and tracks linked from the track store are light and go ahead at any time; a download that is
+  still running when the window closes is finished.
+- The order of a playlist's new tracks: tracks that are linked from the track store come first, then
+  the tracks grouped by album, smaller albums first, so albums (and their covers) are done one by one
+  and progress shows early. The listing has no track sizes or durations to go by.
+"""
+import os
+import time
+import logging
+import threading
+from rate_limit import ByteBucket
+from utils import track_id_from_link
+import content_store
+
+def parse_window(text):
+    # "22:00-06:00" -> (start, end) in minutes after midnight; the window may span midnight
+    try:
+        start, end = (time.strptime(part.strip(), "%H:%M") for part in text.split("-"))
+    except ValueError:
+        raise ValueError(f"{text!r} is not a time window like 22:00-06:00")
+    start, end = start.tm_hour * 60 + start.tm_min, end.tm_hour * 60 + end.tm_min
+    if start == end:
+        raise ValueError(f"The time window {text!r} is empty")
+    return start, end
+
+class Scheduler:
+    def __init__(self, rate=None, window=None, order="album"):
+        self.bucket = ByteBucket(rate) if rate else None
+        self.window = parse_window(window) if window else None
+        self.window_text = window
+        self.order = order
+        self.lock = threading.Lock()
+        self.announced = False
+
+    def throttle(self, size):
+        if self.bucket is not None:
+            self.bucket.consume(size)
+
+    def seconds_to_window(self, now=None):
+        # 0 inside the window, else the seconds until it opens
+        if self.window is None:
+            return 0
+        now = time.localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        start, end = self.window
+        inside = start <= minute < end if start < end else minute >= start or minute < end
+        if inside:
+            return 0
+        return ((start - minute) % (24 * 60)) * 60 - now.tm_sec
+
+    def wait_for_window(self):
+        # Blocks until downloads may start, returns whether it had to wait
+        wait = self.seconds_to_window()
+        if wait <= 0:
+            return False
+        with self.lock:
+            if not self.announced: # Once for all the workers waiting
+                self.announced = True
+                opens = time.strftime("%H:%M", time.localtime(time.time() + wait))
+                print(f"\nDownloads wait for the off-peak window ({self.window_text}), starting at {opens}")
+                logging.info(f"Waiting {wait}s for the off-peak window {self.window_text}")
+        while wait > 0:
+            time.sleep(min(wait, 60)) # Rechecked, the clock may jump (suspend, DST)
+            wait = self.seconds_to_window()
+        with self.lock:
+            self.announced = False
+        return True
+
+    def order_tracks(self, tracknames, song_list_dict):
+        if self.order == "playlist":
+            return list(tracknames)
+        linked, albums = [], {}
+        for trackname in tracknames:
+            song = song_list_dict[trackname]
+            if content_store.enabled() and os.path.exists(content_store.path_for(track_id_from_link(song.link))):
+                linked.append(trackname)
+            else:
+                albums.setdefault((song.album, song.cover), []).append(trackname)
+        # sorted() is stable, albums of the same size keep the order of the listing
+        return linked + [trackname for album in sorted(albums.values(), key=len) for trackname in album]
+
+scheduler = Scheduler()
+
+def configure(rate=None, window=None, order="album"):
+    # rate in bytes per second (None: no cap), window like "22:00-06:00" (None: any time)
+    global scheduler
+    scheduler = Scheduler(rate, window, order)
+
+def throttle(size):
+    scheduler.throttle(size)
+
+def wait_for_window():
+    return scheduler.wait_for_window()
+
+def order_tracks(tracknames, song_list_dict):
+    return scheduler.order_tracks(tracknames, song_list_dict)
@@ -0,0 +1,96 @@
+import os
+import json
+from bisect import bisect_left
+from utils import write_atomic
+
+# Last known track listing of every playlist/album, stored under <cache dir>/playlists,
+# so a sync only has to deal with what changed since the previous run.
+
+# Metadata fields that change whenever the listing changes (e.g. Spotify's snapshot_id)
+CHANGE_MARKER_KEYS = ("snapshotId", "snapshot_id", "snapshot")
+
+_snapshot_dir = None
+
+def configure(cache_dir=None):
+    global _snapshot_dir
+    _snapshot_dir = os.path.join(cache_dir, "playlists") if cache_dir else None
+
+def enabled():
+    return _snapshot_dir is not None
+
+def snapshot_path(mode, playlist_id):
+    return os.path.join(_snapshot_dir, f"{mode}_{playlist_id}.json")
+
+def load_snapshot(mode, playlist_id):
+    if not enabled():
+        return None
+    try:
+        with open(snapshot_path(mode, playlist_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_snapshot(mode, playlist_id, marker, name, track_list):
+    if not enabled():
+        return
+    snapshot = {
+        "marker": marker,
+        "name": name,
+        "tracks": track_list,
+    }
+    write_atomic(snapshot_path(mode, playlist_id), json.dumps(snapshot).encode("utf-8"))
+
+def change_marker(metadata):
+    for key in CHANGE_MARKER_KEYS:
+        if metadata.get(key):
+            return str(metadata[key])
+    return None
+
+def longest_increasing_run(positions):
+    # Indexes of one longest increasing subsequence of positions (patience sorting)
+    tails, tail_indexes, previous = [], [], [None] * len(positions)
+    for i, position in enumerate(positions):
+        j = bisect_left(tails, position)
+        if j == len(tails):
+            tails.append(position)
+            tail_indexes.append(i)
+        else:
+            tails[j] = position
+            tail_indexes[j] = i
+        previous[i] = tail_indexes[j - 1] if j else None
+    run = set()
+    i = tail_indexes[-1] if tail_indexes else None
+    while i is not None:
+        run.add(i)
+        i = previous[i]
+    return run
+
+def diff_listings(old_tracks, new_tracks):
+    """Returns the (added, removed, moved) track IDs between two listings.
+    Moved is the smallest set of tracks whose relocation explains the new order."""
+    old_ids = [track['id'] for track in old_tracks]
+    new_ids = [track['id'] for track in new_tracks]
+    old_set, new_set = set(old_ids), set(new_ids)
+    added = [track_id for track_id in new_ids if track_id not in old_set]
+    removed = [track_id for track_id in old_ids if track_id not in new_set]
+
+    old_positions = {track_id: i for i, track_id in enumerate(old_ids)}
+    kept = [track_id for track_id in new_ids if track_id in old_set]
+    in_order = longest_increasing_run([old_positions[track_id] for track_id in kept])
+    moved = [track_id for i, track_id in enumerate(kept) if i not in in_order]
+    return added, removed, moved
+
+def first_positions(tracks):
+    positions = {}
+    for position, track in enumerate(tracks, 1):
+        positions.setdefault(track['id'], position)
+    return positions
+
+def renumbered(old_tracks, new_tracks):
+    """Track ID -> new position (from 1) of the tracks in both listings whose position changed,
+    because they moved or because tracks before them were added or removed."""
+    old_positions = first_positions(old_tracks)
+    return {
+        track_id: position for track_id, position in first_positions(new_tracks).items()
+        if old_positions.get(track_id, position) != position
+    }
@@ -1,32 +1,121 @@
-import requests
-from config import CUSTOM_HEADER
-from utils import make_unique_song_objects
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import LISTING_CONCURRENCY
+from http_client import api_get
+from metrics import timed
+from utils import make_unique_song_objects, track_id_from_link, echo
+from track_cache import save_track_info
+from token_manager import tokens
+from snapshots import load_snapshot, save_snapshot, change_marker, diff_listings
 
 def get_track_info(link, token):
-    track_id = link.split("/")[-1].split("?")[0]
-    response = requests.get(f"https://api.spotidownloader.com/download/{track_id}?token={token}", headers=CUSTOM_HEADER)
-    return response.json()
+    track_id = track_id_from_link(link)
+    with timed("api_track_info"):
+        response = api_get(f"download/{track_id}?token={token}")
+        resp = response.json()
+    if resp.get('success') and resp.get('metadata'):
+        save_track_info(track_id, resp['metadata'], resp.get('link'))
+    return resp
 
-def get_playlist_info(link, trackname_convention, mode, token):
+def get_playlist_metadata(link, mode, token):
     playlist_id = link.split("/")[-1].split("?")[0]
-    response = requests.get(f"https://api.spotidownloader.com/metadata/{mode}/{playlist_id}?token={token}", headers=CUSTOM_HEADER)
-    metadata = response.json()
-    playlist_name = metadata['title']
+    with timed("api_metadata"):
+        response = api_get(f"metadata/{mode}/{playlist_id}?token={token}")
+        metadata = response.json()
     if metadata['success']:
-        print("-" * 40)
-        print(f"Name: {playlist_name} by {metadata['artists']}")
-    
-    print(f"Getting songs from {mode} (this might take a while ...)")
-    track_list = []
-    response = requests.get(f"https://api.spotidownloader.com/tracks/{mode}/{playlist_id}?token={token}", headers=CUSTOM_HEADER)
-    tracks_data = response.json()
-    track_list.extend(tracks_data['trackList'])
+        echo("-" * 40)
+        echo(f"Name: {metadata['title']} by {metadata['artists']}")
+    return metadata
+
+def request_tracks_page(playlist_id, mode, token, offset=None):
+    with timed("api_tracks_page"):
+        if offset:
+            response = api_get(f"tracks/{mode}/{playlist_id}?offset={offset}&token={token}")
+        else:
+            response = api_get(f"tracks/{mode}/{playlist_id}?token={token}")
+        if response.status_code == 403:
+            return {"statusCode": 403}
+        return response.json()
+
+def get_tracks_page(playlist_id, mode, offset=None):
+    # The token is taken for every page: long listings are read between downloads, past the token's lifetime
+    token = tokens.get()
+    tracks_data = request_tracks_page(playlist_id, mode, token, offset)
+    if tracks_data.get("statusCode") == 403:
+        logging.error("Token rejected while listing. Requested new token")
+        tracks_data = request_tracks_page(playlist_id, mode, tokens.refresh(token), offset)
+    if "trackList" not in tracks_data:
+        raise ValueError(tracks_data.get("message", f"Could not list the tracks of {mode} {playlist_id}"))
+    return tracks_data
+
+def iter_track_pages(playlist_id, mode, concurrency=LISTING_CONCURRENCY):
+    """Yields (offset, trackList) page by page, in order.
+    When the offsets turn out to be plain positions (the second page starts right after the first one),
+    the following pages are requested `concurrency` at a time instead of one after the other."""
+    tracks_data = get_tracks_page(playlist_id, mode)
+    yield None, tracks_data['trackList']
     next_offset = tracks_data['nextOffset']
+    page_size = len(tracks_data['trackList'])
+    if not next_offset or str(next_offset) != str(page_size) or concurrency <= 1:
+        while next_offset:
+            tracks_data = get_tracks_page(playlist_id, mode, next_offset)
+            yield next_offset, tracks_data['trackList']
+            next_offset = tracks_data['nextOffset']
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        offset = page_size
+        pending = deque()
+        while True:
+            while len(pending) < concurrency:
+                pending.append((offset, executor.submit(get_tracks_page, playlist_id, mode, offset)))
+                offset += page_size
+            page_offset, future = pending.popleft()
+            tracks_data = future.result()
+            yield page_offset, tracks_data['trackList']
+            next_offset = tracks_data['nextOffset']
+            if not next_offset or str(next_offset) != str(page_offset + page_size):
+                break
+        # Pages requested past the end (or guessed wrong) are not used
+        for _, future in pending:
+            future.cancel()
     while next_offset:
-        response = requests.get(f"https://api.spotidownloader.com/tracks/{mode}/{playlist_id}?offset={next_offset}&token={token}", headers=CUSTOM_HEADER)
-        tracks_data = response.json()
-        track_list.extend(tracks_data['trackList'])
+        tracks_data = get_tracks_page(playlist_id, mode, next_offset)
+        yield next_offset, tracks_data['trackList']
         next_offset = tracks_data['nextOffset']
 
+def iter_playlist_tracks(link, mode, metadata, concurrency=LISTING_CONCURRENCY, on_change=None):
+    """Yields the playlist's tracks page by page, as soon as each page arrives.
+    Reuses the snapshot of the previous run if the playlist reports no change since then,
+    and snapshots the listing once it has been read completely.
+    on_change(old tracks, new tracks) is called once the listing is complete, if it changed since the snapshot."""
+    playlist_id = link.split("/")[-1].split("?")[0]
+    snapshot = load_snapshot(mode, playlist_id)
+    marker = change_marker(metadata)
+    if snapshot and marker is not None and snapshot['marker'] == marker:
+        echo(f"No changes to this {mode} since the last sync")
+        yield snapshot['tracks']
+        return
+
+    echo(f"Getting songs from {mode} (this might take a while ...)")
+    track_list = []
+    for _, page in iter_track_pages(playlist_id, mode, concurrency):
+        track_list.extend(page)
+        yield page
+    if snapshot:
+        added, removed, moved = diff_listings(snapshot['tracks'], track_list)
+        echo(f"Changes since the last sync: {len(added)} added, {len(removed)} removed, {len(moved)} moved")
+        if on_change is not None and (added or removed or moved):
+            on_change(snapshot['tracks'], track_list)
+    save_snapshot(mode, playlist_id, marker, metadata['title'], track_list)
+
+def get_playlist_tracks(link, mode, metadata):
+    return [track for page in iter_playlist_tracks(link, mode, metadata) for track in page]
+
+def get_playlist_info(link, trackname_convention, mode):
+    metadata = get_playlist_metadata(link, mode, tokens.get())
+    playlist_name = metadata['title']
+    track_list = get_playlist_tracks(link, mode, metadata)
     song_list_dict = make_unique_song_objects(track_list, trackname_convention, playlist_name, mode)
     return song_list_dict, playlist_name
@@ -2,24 +2,156 @@ import os
 import json
 import re
 import logging
-from downloader import check_track_playlist
-from utils import get_token, trackname_convention
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from downloader import check_track_playlist, prepare_playlist_tracks, buffered_playlist_track, remove_empty_files, track_outcome
+from progress import ProgressRenderer
+from models import PlaylistJob
+from scheduler import order_tracks
+from utils import get_token, trackname_convention, resolve_path, buffered_call, echo, track_id_from_link, sanitize_name
 from spotify_api import get_playlist_info
 
-def sync_playlist_folders(sync_file):
+def read_sync_file(sync_file):
+    # Returns (entry, trackname convention) for every album/playlist/track of the sync file
     with open(sync_file, "r") as file:
         data_to_sync = json.load(file)
-        set_trackname_convention = 1
-        for data in data_to_sync:
-            if data.get("convention_code"):
-                set_trackname_convention = data["convention_code"]
+    set_trackname_convention = 1
+    entries = []
+    for data in data_to_sync:
+        if data.get("convention_code"):
+            set_trackname_convention = data["convention_code"]
+            continue
+        entries.append((data, set_trackname_convention))
+    return entries
+
+def sync_entries(entries, workers=1, quality="all"):
+    if workers <= 1:
+        for data, set_trackname_convention in entries:
+            check_track_playlist(data['link'], data['download_location'], data['create_folder'], set_trackname_convention, token=get_token(), workers=workers, quality=quality)
+    elif entries:
+        sync_concurrently(entries, workers, quality)
+
+def sync_playlist_folders(sync_file, workers=1, quality="all"):
+    sync_entries(read_sync_file(sync_file), workers, quality)
+
+def round_robin(queues):
+    # Takes one item from each queue in turn, so long queues cannot starve short ones
+    queues = [list(queue) for queue in queues]
+    for i in range(max((len(queue) for queue in queues), default=0)):
+        for queue in queues:
+            if i < len(queue):
+                yield queue[i]
+
+def prepare_entry(data, set_trackname_convention, concurrency=1):
+    token = get_token() # Listings may start long after the sync did
+    link = data['link']
+    mode = 'album' if re.search(r".*spotify\.com\/album\/", link) else 'playlist'
+    journal, outpath, playlist_name, song_list_dict = prepare_playlist_tracks(link, data['download_location'], data['create_folder'], set_trackname_convention, token, mode, concurrency)
+    return PlaylistJob(playlist_name, outpath, song_list_dict, journal=journal)
+
+def claim_tracks(job, claimed):
+    """Drops the tracks of job that an earlier playlist downloads into the same folder, and claims the rest.
+    Both would write the same temp file at the same time. Returns the number of tracks dropped."""
+    folder = os.path.normcase(os.path.abspath(job.outpath))
+    dropped = 0
+    for trackname, song in list(job.song_list_dict.items()):
+        keys = {(folder, track_id_from_link(song.link)), (folder, sanitize_name(trackname))}
+        if claimed & keys:
+            del job.song_list_dict[trackname]
+            dropped += 1
+        claimed |= keys
+    return dropped
+
+def sync_concurrently(entries, workers, quality, max_attempts=3):
+    """Syncs all playlists at once. At most `workers` requests (listings first, then tracks) are in
+    flight in total, and tracks of all playlists are queued round-robin so every playlist progresses."""
+    get_token() # Might ask for it, so not from a worker
+    playlists = []
+    for data, set_trackname_convention in entries:
+        if re.search(r".*spotify\.com\/(?:intl-[a-zA-Z]{2}\/)?track\/", data['link']):
+            check_track_playlist(data['link'], data['download_location'], data['create_folder'], set_trackname_convention, get_token(), quality=quality)
+        else:
+            resolve_path(data['download_location']) # Might ask to create it, so not from a worker
+            playlists.append((data, set_trackname_convention))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Each listing fetches its pages `concurrency` at a time, so listings stay within the worker budget too
+        concurrency = max(1, workers // len(playlists)) if playlists else 1
+        futures = [
+            executor.submit(buffered_call, prepare_entry, data, set_trackname_convention, concurrency)
+            for data, set_trackname_convention in playlists
+        ]
+        jobs = []
+        claimed = set()
+        for future in futures:
+            lines, job = future.result()
+            for line in lines:
+                echo(line)
+            if not job.song_list_dict:
                 continue
-            check_track_playlist(data['link'], data['download_location'], data['create_folder'], set_trackname_convention, token=get_token())
+            shared = claim_tracks(job, claimed)
+            if shared:
+                logging.info(f"{job.name}: {shared} track(s) are downloaded into {job.outpath} for another playlist")
+                echo(f"\n{job.name}: {shared} track(s) are already downloading into ({job.outpath}) for another playlist")
+                job.skipped += shared
+            if job.song_list_dict:
+                jobs.append(job)
+            else:
+                job.journal.finish()
+
+        if not jobs:
+            return
+        try:
+            total = sum(len(job.song_list_dict) for job in jobs)
+            echo("-" * 40)
+            echo(f"Downloading {total} new track(s) from {len(jobs)} playlist(s)")
+            echo("-" * 40)
+            progress = ProgressRenderer("Sync", total)
+
+            def track_tasks(job, tracknames, track_quality):
+                job.pending += len(tracknames)
+                return [
+                    ((job, trackname), (index, len(tracknames), trackname, job.song_list_dict[trackname], job.outpath, job.name, max_attempts, track_quality, job.journal))
+                    for index, trackname in enumerate(tracknames, 1)
+                ]
+
+            queued = round_robin([track_tasks(job, order_tracks(job.song_list_dict.keys(), job.song_list_dict), quality) for job in jobs])
+            running = {executor.submit(buffered_playlist_track, *args): key for key, args in queued}
+            deferred = {job: [] for job in jobs}
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, trackname = running.pop(future)
+                    lines, result = future.result()
+                    outcome = track_outcome(result)
+                    progress.report([f"[{job.name}] {lines[0]}"] + lines[1:], outcome)
+                    job.pending -= 1
+                    if outcome == "deferred":
+                        deferred[job].append(trackname)
+                    elif outcome == "downloaded":
+                        job.downloaded += 1
+                    elif outcome == "skipped":
+                        job.skipped += 1
+                    else:
+                        job.failed += 1
+
+                    if job.pending == 0 and deferred[job]:
+                        progress.message(f"\n[{job.name}] Downloading {len(deferred[job])} deferred low quality track(s)")
+                        for key, args in track_tasks(job, deferred[job], "all"):
+                            running[executor.submit(buffered_playlist_track, *args)] = key
+                        deferred[job] = []
+                    elif job.pending == 0:
+                        remove_empty_files(job.outpath)
+                        job.journal.finish()
+                        progress.message(f"[{job.name}] Done: {job.downloaded} downloaded, {job.skipped} skipped, {job.failed} failed", always=True)
+            progress.close()
+        finally:
+            for job in jobs:
+                job.journal.close() # Whatever is still buffered, if the sync did not get to the end
 
-def handle_sync_file(sync_file):
+def handle_sync_file(sync_file, workers=1, quality="all"):
     if (os.path.exists(sync_file)):
         print("Syncing local album/playlist folders with Spotify")
-        sync_playlist_folders(sync_file)
+        sync_playlist_folders(sync_file, workers, quality)
         print("-" * 40)
         print("Sync complete!")
     else:
@@ -0,0 +1,105 @@
+import io
+from mutagen.id3 import ID3, APIC, TRCK, TIT2, TALB, TPE1, TDRC, TXXX
+from mutagen.mp3 import MPEGInfo
+from config import TAG_PADDING
+
+ID3V1_SIZE = 128
+
+# Free space reserved after every tag spdl writes, so later edits fit in it
+_padding = TAG_PADDING
+
+def configure(padding=TAG_PADDING):
+    global _padding
+    _padding = padding
+
+def reserve_padding(info):
+    # mutagen padding policy for new tags
+    return _padding
+
+def keep_padding(info):
+    # mutagen padding policy for tags saved over existing ones: a tag that still fits is written over the
+    # old one without moving the audio after it. Only a tag that outgrows the space makes mutagen rewrite
+    # the whole file, and then a fresh reserve is added for the next edits.
+    return info.padding if info.padding >= 0 else _padding
+
+# User defined text frame holding the Spotify track ID, so files can be indexed regardless of their name
+TRACK_ID_DESC = "SPOTIFY_TRACK_ID"
+
+def id3v2_size(head):
+    # Size of the ID3v2 tag at the start of head (0 if there is none), None if head is too short to tell
+    if len(head) < 10:
+        return None
+    if head[:3] != b"ID3":
+        return 0
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    if head[5] & 0x10: # Footer present
+        size += 10
+    return size + 10
+
+def parse_tags(tag_bytes):
+    return ID3(io.BytesIO(tag_bytes)) if tag_bytes else None
+
+def add_text_frames(tags, metadata):
+    tags.add(TIT2(encoding=3, text=metadata['title']))
+    tags.add(TPE1(encoding=3, text=metadata['artists']))
+    tags.add(TALB(encoding=3, text=metadata['album']))
+    tags.add(TDRC(encoding=3, text=metadata['releaseDate']))
+
+def cover_frame(cover_art):
+    return APIC(
+        encoding=1,
+        mime='image/jpeg',
+        type=3,
+        desc=u'Cover',
+        data=cover_art
+    )
+
+def build_tags(metadata, track_number=0, cover_art=None, tags=None, track_id=None):
+    # Existing tags are kept as they are, only the cover and track number are added to them
+    if tags is None:
+        tags = ID3()
+        add_text_frames(tags, metadata)
+    if cover_art is not None:
+        tags.add(cover_frame(cover_art))
+    if track_number > 0:
+        tags.add(TRCK(encoding=3, text=str(track_number)))
+    if track_id:
+        tags.add(TXXX(encoding=3, desc=TRACK_ID_DESC, text=track_id))
+    return tags
+
+def read_track_id(tags):
+    frame = tags.get(f"TXXX:{TRACK_ID_DESC}") if tags is not None else None
+    return str(frame.text[0]) if frame else None
+
+def save_tags(tags, filepath):
+    tags.save(filepath, v1=2, v2_version=3, padding=keep_padding)
+
+def update_tags(filepath, metadata=None, track_number=0, cover_art=None):
+    """Replaces the text frames (from metadata), the track number and/or the cover art of an existing file.
+    Returns True if the new tag fitted in the space of the old one, so only the start of the file was written."""
+    tags = ID3(filepath)
+    if metadata is not None:
+        add_text_frames(tags, metadata)
+    if cover_art is not None:
+        tags.delall("APIC")
+        tags.add(cover_frame(cover_art))
+    if track_number > 0:
+        tags.add(TRCK(encoding=3, text=str(track_number)))
+    tag_size = tag_size_of(filepath)
+    save_tags(tags, filepath)
+    return tag_size_of(filepath) == tag_size
+
+def tag_size_of(filepath):
+    with open(filepath, "rb") as f:
+        return id3v2_size(f.read(10))
+
+def render_tags(tags):
+    # Same format as audio.save(filepath, v2_version=3, v1=2), returned as (ID3v2 bytes, ID3v1 bytes)
+    buffer = io.BytesIO()
+    tags.save(buffer, v1=2, v2_version=3, padding=reserve_padding)
+    data = buffer.getvalue()
+    return data[:-ID3V1_SIZE], data[-ID3V1_SIZE:]
+
+def probe_bitrate(audio_head):
+    # Bitrate in kbps read from the first MPEG frames (and Xing/LAME header if any)
+    return MPEGInfo(io.BytesIO(audio_head)).bitrate / 1000
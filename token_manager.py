@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import logging
+import threading
+import subprocess
+from config import TOKEN_MAX_AGE, TOKEN_REFRESH_MARGIN
+from metrics import count
+
+CACHE_FILE = "./.cache"
+
+def read_token(source):
+    """Gets a fresh token from the source: "prompt", "env:NAME", "file:PATH" or "cmd:COMMAND" """
+    kind, _, value = source.partition(":")
+    if kind == "prompt":
+        token = input("Enter Token: ")
+    elif kind == "env":
+        token = os.environ.get(value, "")
+    elif kind == "file":
+        with open(value) as f:
+            token = f.read()
+    elif kind == "cmd":
+        token = subprocess.run(value, shell=True, capture_output=True, text=True, check=True).stdout
+    else:
+        raise ValueError(f"Unknown token source: {source}")
+    token = token.strip()
+    if not token:
+        raise ValueError(f"Token source {source} returned no token")
+    return token
+
+class TokenManager:
+    """Keeps the token in memory and gets a new one shortly before it expires or when it is rejected.
+    Only one thread refreshes at a time; the others wait for it and use the token it got."""
+    def __init__(self, source="prompt"):
+        self.source = source
+        self.token = None
+        self.issued_at = 0.0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        token = self.token
+        if token is not None and self.age() < TOKEN_MAX_AGE - TOKEN_REFRESH_MARGIN:
+            return token
+        return self.refresh(token, expired=True)
+
+    def age(self):
+        return time.time() - self.issued_at
+
+    def refresh(self, stale=None, expired=False):
+        """Replaces the stale token. If another thread already replaced it meanwhile, returns that one."""
+        generation = self.generation
+        with self.lock:
+            # Someone else refreshed while we were waiting (even if the source gave the same token back)
+            if self.token is not None and (self.token != stale or self.generation != generation):
+                return self.token
+            if self.token is None and self.load_cached():
+                return self.token
+            if self.token is not None and not expired:
+                logging.error("Token rejected, requesting a new token")
+            token = read_token(self.source)
+            count("token_refreshes", reason="expired" if expired else "rejected")
+            if token == stale and self.source != "prompt":
+                logging.warning(f"Token source {self.source} returned the same token again")
+            self.token = token
+            self.issued_at = time.time()
+            self.generation += 1
+            if self.source == "prompt":
+                # Reused by the next run while it is still valid
+                with open(CACHE_FILE, "w") as f:
+                    json.dump({"token": token}, f)
+            return token
+
+    def load_cached(self):
+        if self.source != "prompt" or not os.path.exists(CACHE_FILE):
+            return False
+        issued_at = os.path.getmtime(CACHE_FILE)
+        if time.time() - issued_at > TOKEN_MAX_AGE - TOKEN_REFRESH_MARGIN:
+            return False
+        with open(CACHE_FILE) as f:
+            token = json.load(f).get("token")
+        if not token:
+            return False
+        self.token = token
+        self.issued_at = issued_at
+        return True
+
+tokens = TokenManager()
+
+def configure(source="prompt"):
+    tokens.source = source
@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from config import TRACK_METADATA_TTL, LINK_MAX_AGE
+from metrics import count
+
+# Metadata the API returns for every track (title, artists, album, releaseDate, cover), keyed by
+# Spotify track ID and kept in <cache dir>/tracks.sqlite across runs (in memory without a cache dir),
+# so naming, tagging and existence checks do not need an API call.
+# Download links expire within minutes, so they are only kept in memory, apart from the metadata.
+CACHE_FILE = "tracks.sqlite"
+METADATA_FIELDS = ("title", "artists", "album", "releaseDate", "cover")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    track_id TEXT PRIMARY KEY,
+    metadata TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+class TrackCache:
+    def __init__(self, cache_dir=None, ttl=TRACK_METADATA_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, CACHE_FILE) if cache_dir else ":memory:"
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.links = {}
+
+    def metadata(self, track_id):
+        # The cached metadata of the track, or None if there is none younger than the TTL
+        with self.lock:
+            row = self.conn.execute("SELECT metadata, fetched_at FROM tracks WHERE track_id = ?", (track_id,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            count("metadata_cache", result="miss")
+            return None
+        count("metadata_cache", result="hit")
+        return json.loads(row[0])
+
+    def save(self, track_id, metadata, link=None):
+        stable = {key: metadata.get(key) for key in METADATA_FIELDS}
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tracks (track_id, metadata, fetched_at) VALUES (?, ?, ?)",
+                (track_id, json.dumps(stable), time.time()),
+            )
+            self.conn.commit()
+            if link:
+                self.links[track_id] = (link, time.monotonic())
+
+    def link(self, track_id, max_age=LINK_MAX_AGE):
+        # A download link resolved less than max_age seconds ago, or None
+        with self.lock:
+            link, resolved_at = self.links.get(track_id, (None, 0))
+            if link is not None and time.monotonic() - resolved_at > max_age:
+                del self.links[track_id]
+                return None
+            return link
+
+    def forget_link(self, track_id):
+        with self.lock:
+            self.links.pop(track_id, None)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+track_cache = TrackCache()
+
+def configure(cache_dir=None, ttl=TRACK_METADATA_TTL):
+    global track_cache
+    track_cache.close()
+    track_cache = TrackCache(cache_dir, ttl)
+
+def cached_metadata(track_id):
+    return track_cache.metadata(track_id)
+
+def save_track_info(track_id, metadata, link=None):
+    track_cache.save(track_id, metadata, link)
+
+def cached_link(track_id):
+    return track_cache.link(track_id)
+
+def forget_link(track_id):
+    track_cache.forget_link(track_id)
@@ -0,0 +1,195 @@
+import os
+import json
+import logging
+from http_client import audio_get
+from tagging import ID3V1_SIZE, id3v2_size, parse_tags, render_tags, probe_bitrate
+from metrics import timed, count
+from scheduler import throttle
+
+CHUNK_SIZE = 64 * 1024
+
+# Audio bytes buffered after the source ID3v2 tag before the bitrate is probed
+PROBE_BYTES = 16 * 1024
+
+# A partially downloaded temp file is accompanied by "<temp file>.part", which records
+# the expected length and the validator (ETag / Last-Modified) of the response it came from,
+# so that an interrupted download can be resumed with a Range request. It also records
+# how the temp file maps onto the source: "header" bytes of (new) tag were written in place
+# of the "skip" bytes of source tag, so the source offset is skip + (size - header).
+
+def sidecar_path(temp_file):
+    return f"{temp_file}.part"
+
+def load_sidecar(temp_file):
+    try:
+        with open(sidecar_path(temp_file)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_sidecar(temp_file, state):
+    with open(sidecar_path(temp_file), "w") as f:
+        json.dump(state, f)
+
+def discard_partial(temp_file):
+    for path in (temp_file, sidecar_path(temp_file)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def response_validator(response):
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"): # If-Range only accepts strong validators
+        return etag
+    return response.headers.get("Last-Modified")
+
+def content_range_total(response):
+    # "bytes 1000-9999/10000" -> 10000
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+def resume_offset(temp_file, state):
+    if not state or state.get("header") is None or not os.path.exists(temp_file):
+        return 0
+    written = os.path.getsize(temp_file) - state["header"]
+    return state["skip"] + written if written >= 0 else 0
+
+class TrackWriter:
+    """Writes a downloaded MP3 into file in a single pass.
+
+    The source ID3v2 tag and the first audio frames are buffered, the bitrate is probed
+    from them and the tag returned by make_tags(source_tags) is written in front of the
+    audio. The last bytes are held back so a source ID3v1 tag can be replaced by the new one.
+    Without make_tags the source is copied unchanged.
+    """
+
+    def __init__(self, file, state, make_tags=None):
+        self.file = file
+        self.state = state
+        self.make_tags = make_tags
+        self.pending = b""
+        self.tail = b""
+
+    def write(self, chunk):
+        if self.state.get("header") is not None:
+            self.write_audio(chunk)
+            return
+        self.pending += chunk
+        tag_size = id3v2_size(self.pending)
+        if tag_size is not None and len(self.pending) >= tag_size + PROBE_BYTES:
+            self.start(tag_size)
+
+    def start(self, tag_size):
+        source_tag, audio = self.pending[:tag_size], self.pending[tag_size:]
+        self.pending = b""
+        with timed("bitrate_probe"):
+            self.state["bitrate"] = probe_bitrate(audio)
+        if self.make_tags is None:
+            header, v1 = source_tag, None
+        else:
+            with timed("tag_render"):
+                header, v1 = render_tags(self.make_tags(parse_tags(source_tag)))
+        self.file.write(header)
+        self.state.update(header=len(header), skip=tag_size, v1=v1.hex() if v1 else None)
+        self.write_audio(audio)
+
+    def write_audio(self, data):
+        data = self.tail + data
+        self.file.write(data[:-ID3V1_SIZE])
+        self.tail = data[-ID3V1_SIZE:]
+
+    def finish(self):
+        if self.state.get("header") is None: # Whole file was shorter than the probe window
+            self.start(min(id3v2_size(self.pending) or 0, len(self.pending)))
+        if self.state.get("v1") is None:
+            self.file.write(self.tail)
+            return
+        if not (len(self.tail) == ID3V1_SIZE and self.tail.startswith(b"TAG")):
+            self.file.write(self.tail)
+        self.file.write(bytes.fromhex(self.state["v1"]))
+
+def fetch_range(link, start, size):
+    # Returns up to size bytes from start, or None if the server could not serve them.
+    # Servers that ignore Range answer 200 with the whole file, so only read what is needed.
+    with audio_get(link, headers={"Range": f"bytes={start}-{start + size - 1}"}, stream=True) as response:
+        if response.status_code != 206 and (response.status_code != 200 or start):
+            return None
+        data = b""
+        for chunk in response.iter_content(CHUNK_SIZE):
+            throttle(len(chunk))
+            data += chunk
+            if len(data) >= size:
+                break
+        return data[:size]
+
+def probe_remote_bitrate(link):
+    """Reads the bitrate (kbps) of the audio behind link from its first frames, without downloading it.
+    Returns None if it could not be determined."""
+    head = fetch_range(link, 0, PROBE_BYTES)
+    tag_size = id3v2_size(head) if head is not None else None
+    if tag_size is None:
+        return None
+    audio = head[tag_size:]
+    if len(audio) < PROBE_BYTES // 4 and len(head) == PROBE_BYTES:
+        # Large source tag (e.g. embedded art), fetch the frames behind it
+        audio = fetch_range(link, tag_size, PROBE_BYTES)
+        if audio is None:
+            return None
+    try:
+        return probe_bitrate(audio)
+    except Exception as e:
+        logging.error(f"Could not probe bitrate of {link} --> {e}")
+        return None
+
+def download_to_file(link, temp_file, make_tags=None):
+    """Streams link into temp_file, resuming a previous partial download if possible.
+    Returns (status code, bitrate in kbps); the bitrate is None unless the status code is 200."""
+    state = load_sidecar(temp_file)
+    offset = resume_offset(temp_file, state)
+
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        if state.get("validator"):
+            headers["If-Range"] = state["validator"]
+
+    with audio_get(link, headers=headers, stream=True) as response:
+        if response.status_code == 206 and offset:
+            if content_range_total(response) != state.get("length"):
+                discard_partial(temp_file)
+                raise IOError("Partial download no longer matches the remote file, restarting")
+            logging.info(f"Resuming download of {temp_file} from byte {offset}")
+            mode = "ab"
+        elif response.status_code == 200:
+            length = response.headers.get("Content-Length")
+            state = {
+                "length": int(length) if length and length.isdigit() else None,
+                "validator": response_validator(response),
+            }
+            write_sidecar(temp_file, state)
+            offset = 0
+            mode = "wb"
+        elif response.status_code == 416 and offset:
+            discard_partial(temp_file)
+            raise IOError("Partial download is no longer valid, restarting")
+        else:
+            return response.status_code, None
+
+        received = offset
+        header_saved = mode == "ab"
+        with timed("audio_transfer"), open(temp_file, mode) as file:
+            writer = TrackWriter(file, state, make_tags)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                throttle(len(chunk)) # Reading slower is what slows the sender down
+                writer.write(chunk)
+                received += len(chunk)
+                count("bytes", len(chunk), kind="audio")
+                if not header_saved and state.get("header") is not None:
+                    # From here on the temp file can be resumed
+                    write_sidecar(temp_file, state)
+                    header_saved = True
+            if state["length"] is not None and received != state["length"]:
+                raise IOError(f"Incomplete download ({received}/{state['length']} bytes)")
+            writer.finish()
+
+    os.remove(sidecar_path(temp_file))
+    return 200, state["bitrate"]
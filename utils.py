@@ -1,9 +1,57 @@
 import os
-import re
-import json
-import time
+import threading
+from contextlib import contextmanager
 from config import NAME_SANITIZE_REGEX
 from models import Song
+from token_manager import tokens
+
+_console = threading.local()
+
+# quiet: only failures and summaries, progress: a status line per batch of tracks, verbose: every track
+OUTPUT_MODES = ("quiet", "progress", "verbose")
+_output_mode = "progress"
+
+def set_output_mode(mode):
+    global _output_mode
+    _output_mode = mode
+
+def output_mode():
+    return _output_mode
+
+def echo(*args):
+    # Prints straight away, unless the current thread is collecting its output
+    # so that concurrent tracks do not interleave their lines on the console.
+    buffer = getattr(_console, "buffer", None)
+    if buffer is None:
+        if _output_mode != "quiet":
+            print(*args)
+    else:
+        buffer.append(" ".join(str(arg) for arg in args))
+
+@contextmanager
+def buffered_output():
+    _console.buffer = []
+    try:
+        yield _console.buffer
+    finally:
+        _console.buffer = None
+
+def buffered_call(function, *args):
+    # Runs function collecting its console output, returns (output lines, result)
+    with buffered_output() as lines:
+        result = function(*args)
+    return lines, result
+
+def track_id_from_link(link):
+    return link.split("/")[-1].split("?")[0]
+
+def write_atomic(path, data):
+    # Readers see either the old or the new content, never a partially written file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
 
 def resolve_path(outpath, playlist_folder=False):
     if not os.path.exists(outpath):
@@ -15,45 +63,66 @@ def resolve_path(outpath, playlist_folder=False):
             print("Exiting program")
             exit()
 
-def dict_unique(song_list, trackname_convention):
+def sanitize_name(name):
+    # Most names have nothing to replace, and searching is much cheaper than substituting
+    return NAME_SANITIZE_REGEX.sub("_", name) if NAME_SANITIZE_REGEX.search(name) else name
+
+def make_trackname(title, artists, trackname_convention):
+    trackname = f"{artists} - {title}" if trackname_convention == 2 else f"{title} - {artists}"
+    if len(trackname) > 260: # Added because you can't have filenames with more that 260 chars
+        trackname = title[:255] + "..." # Just in case there is a song out there with a very very large title
+    return trackname
+
+def make_unique_song_objects(track_list, trackname_convention, album_name, mode, known_ids=None, start=1, seen_names=None, seen_ids=None):
+    # Tracks in known_ids (already downloaded) are left out, without changing the numbering of the others.
+    # For a listing processed page by page, start is the position of the page's first track, and
+    # seen_names / seen_ids carry the names and track IDs of the earlier pages.
+    # A track is a duplicate if its name or its ID was seen before; a Song is only built for the first one.
+    seen_names = set() if seen_names is None else seen_names
+    seen_ids = set() if seen_ids is None else seen_ids
+    known_ids = known_ids or ()
     unique_songs = {}
     duplicate_songs = []
-    for song in song_list:
-        trackname = f"{song.title} - {song.artists}"
-        if trackname_convention == 2:
-            trackname = f"{song.artists} - {song.title}"
-        if len(trackname) > 260: # Added because you can't have filenames with more that 260 chars
-            trackname = song.title[:255] + "..." # Just in case there is a song out there with a very very large title
-        if (unique_songs.get(trackname)):
+    known = 0
+    by_position = mode == 'playlist'
+    by_album = mode == 'album'
+    sanitized_artists = {} # The same artists come back again and again in large listings
+    for i, track in enumerate(track_list, start):
+        track_id = track['id']
+        if track_id in known_ids:
+            known += 1
+            continue
+        title = sanitize_name(track['title'])
+        artists = track['artists']
+        artists = sanitized_artists.get(artists) or sanitized_artists.setdefault(artists, sanitize_name(artists))
+        trackname = make_trackname(title, artists, trackname_convention)
+        if trackname in seen_names or track_id in seen_ids:
             duplicate_songs.append(trackname)
-        else:
-            unique_songs.setdefault(trackname, song)
-    return unique_songs, duplicate_songs
-
-def make_unique_song_objects(track_list, trackname_convention, album_name, mode):
-    song_list = []
-    for i, track in enumerate(track_list, 1):
-        song_list.append(
-            Song(
-                title=re.sub(NAME_SANITIZE_REGEX, "_", track['title']),
-                artists=re.sub(NAME_SANITIZE_REGEX, "_", track['artists']),
-                album = album_name if mode == 'album' else track.get('album'),
-                cover=track.get('cover', 'default_cover.png'),
-                link=f"https://open.spotify.com/track/{track['id']}",
-                track_number=i if mode == 'playlist' else track.get('trackNumber')
-            )
+            continue
+        seen_names.add(trackname)
+        seen_ids.add(track_id)
+        unique_songs[trackname] = Song(
+            title,
+            artists,
+            album_name if by_album else track.get('album'),
+            track.get('cover', 'default_cover.png'),
+            "https://open.spotify.com/track/" + track_id,
+            i if by_position else track.get('trackNumber'),
         )
-    # unique_songs = set_unique(song_list)
-    unique_songs, duplicate_songs = dict_unique(song_list, trackname_convention)
 
-    if (len(duplicate_songs)):
-        print("\tDuplicate songs: ", len(duplicate_songs))
-        for index, song_name in enumerate(duplicate_songs, 1):
-            print(f"\t\t{index}: {song_name}")
+    # The listing is long for large playlists, so it is only printed in verbose mode
+    if _output_mode == "verbose":
+        if known:
+            echo("\tAlready downloaded: ", known)
+
+        if (len(duplicate_songs)):
+            echo("\tDuplicate songs: ", len(duplicate_songs))
+            for index, song_name in enumerate(duplicate_songs, 1):
+                echo(f"\t\t{index}: {song_name}")
 
-    print("\n\tUnique Songs in playlist: ", len(unique_songs))
-    for index, song_name in enumerate(unique_songs.keys(), 1):
-        print(f"\t\t{index}: {song_name}")
+        echo("\n\tUnique Songs in playlist: ", len(unique_songs))
+        for index, song_name in enumerate(unique_songs.keys(), 1):
+            echo(f"\t\t{index}: {song_name}")
     
     return unique_songs
 
@@ -71,19 +140,5 @@ def trackname_convention():
         return "Title - Artist", 1
 
 def get_token(reset=False):
-    cache_file = "./.cache"
-    if os.path.exists(cache_file) and not reset:
-
-        file_age = time.time() - os.path.getmtime(cache_file)
-
-        if file_age > 540:
-            reset = True
-
-    if reset or not os.path.exists(cache_file):
-        token = input("Enter Token: ").strip()
-        with open(cache_file, "w") as f:
-            json.dump({"token": token}, f)
-    else:
-        with open(cache_file) as f:
-            token = json.load(f).get("token")
-    return token
+    # The token lives in the token manager, which also takes care of its expiry
+    return tokens.refresh(tokens.token) if reset else tokens.get()